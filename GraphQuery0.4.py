@@ -1,30 +1,286 @@
 import json
+import csv
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 import os
-import inquirer
+import sys
+import sqlite3
+import time
+import random
+from datetime import datetime, timezone
+from decimal import Decimal, ROUND_DOWN
+import queue
+import threading
+import itertools
+import contextlib
+import io
+import functools
+import hashlib
+import weakref
+import argparse
+from dataclasses import dataclass, asdict, astuple
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
 
-# File to store subgraph links and addresses
+try:
+    import numpy  # Only needed for the vectorized engine
+except ImportError:
+    numpy = None
+
+try:
+    import orjson  # Faster JSON decoding of subgraph responses when installed
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow  # Only needed for Parquet and Arrow exports
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Registry of chains, their endpoints, addresses, address tags and groups, and the chains each address
+# is a member of (an address without chain memberships belongs to every chain)
+registry_file = "subgraph_registry.db"
+registry_lock = threading.Lock()
+registry_ready = False
+
+# JSON file that held subgraph links and addresses before the registry; imported into an empty registry
 storage_file = "subgraph_data.json"
 
 
-# Load or initialize subgraph data from the file
+# Open the registry database, creating its tables on first use and importing the JSON file into it
+def open_registry():
+    global registry_ready
+    connection = sqlite3.connect(registry_file, timeout=30)
+    connection.execute("PRAGMA foreign_keys = ON")
+    if not registry_ready:
+        # Chains and addresses are listed in the order they were added (rowid order)
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS chains (
+                name TEXT PRIMARY KEY,
+                strategy TEXT NOT NULL DEFAULT 'events'
+            );
+            CREATE TABLE IF NOT EXISTS endpoints (
+                chain TEXT NOT NULL REFERENCES chains (name) ON DELETE CASCADE,
+                url TEXT NOT NULL,
+                PRIMARY KEY (chain, url)
+            );
+            CREATE TABLE IF NOT EXISTS addresses (
+                name TEXT PRIMARY KEY,
+                address TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS address_tags (
+                tag TEXT NOT NULL,
+                address_name TEXT NOT NULL REFERENCES addresses (name) ON DELETE CASCADE,
+                PRIMARY KEY (tag, address_name)
+            );
+            CREATE INDEX IF NOT EXISTS address_tags_by_address ON address_tags (address_name);
+            CREATE TABLE IF NOT EXISTS address_groups (
+                group_name TEXT NOT NULL,
+                address_name TEXT NOT NULL REFERENCES addresses (name) ON DELETE CASCADE,
+                PRIMARY KEY (group_name, address_name)
+            );
+            CREATE TABLE IF NOT EXISTS address_chains (
+                address_name TEXT NOT NULL REFERENCES addresses (name) ON DELETE CASCADE,
+                chain TEXT NOT NULL,
+                PRIMARY KEY (address_name, chain)
+            );
+        """)
+
+        # Registries created before position strategies have no strategy column
+        columns = [column[1] for column in connection.execute("PRAGMA table_info(chains)")]
+        if 'strategy' not in columns:
+            connection.execute("ALTER TABLE chains ADD COLUMN strategy TEXT NOT NULL DEFAULT 'events'")
+            connection.commit()
+
+        empty = not connection.execute("SELECT 1 FROM chains UNION ALL SELECT 1 FROM addresses LIMIT 1").fetchone()
+        if empty and os.path.exists(storage_file):
+            with open(storage_file, 'r') as f:
+                data = json.load(f)
+            with connection:
+                write_registry(connection, data)
+            # A notice rather than output, kept off stdout so JSON output stays parseable
+            print(f"Imported {len(data['subgraphs'])} chains and {len(data['addresses'])} addresses "
+                  f"from {storage_file} into {registry_file}", file=sys.stderr)
+        elif (not empty and os.path.exists(storage_file) and
+              os.path.getmtime(storage_file) > os.path.getmtime(registry_file)):
+            # The file is only imported once; edits made to it since then have no effect
+            print(f"Warning: {storage_file} is newer than {registry_file} and is ignored; change chains with "
+                  f"--set-endpoints and --set-strategy and addresses with --import-addresses", file=sys.stderr)
+        registry_ready = True
+    return connection
+
+
+# Replace the registry's contents with subgraph data, inside the caller's transaction
+def write_registry(connection, data):
+    connection.execute("DELETE FROM chains")
+    connection.execute("DELETE FROM addresses")
+    for subgraph_name, link in data['subgraphs'].items():
+        write_chain(connection, subgraph_name, (link if isinstance(link, list) else [link]) +
+                    data.get('mirrors', {}).get(subgraph_name, []), data.get('strategies', {}).get(subgraph_name))
+    members = {}
+    for group_name, address_names in data.get('groups', {}).items():
+        for address_name in address_names:
+            members.setdefault(address_name, []).append(group_name)
+    for address_name, address in data['addresses'].items():
+        write_address(connection, address_name, address, data.get('tags', {}).get(address_name, []),
+                      members.get(address_name, []), data.get('address_chains', {}).get(address_name, []))
+
+
+# Store a chain and its endpoints, the first of which names the chain in caches, and set its position
+# strategy if one is given
+def write_chain(connection, subgraph_name, endpoints, strategy=None):
+    connection.execute("INSERT OR IGNORE INTO chains (name) VALUES (?)", (subgraph_name,))
+    if strategy is not None:
+        connection.execute("UPDATE chains SET strategy = ? WHERE name = ?", (strategy, subgraph_name))
+    connection.execute("DELETE FROM endpoints WHERE chain = ?", (subgraph_name,))
+    connection.executemany("INSERT OR IGNORE INTO endpoints (chain, url) VALUES (?, ?)",
+                           [(subgraph_name, endpoint) for endpoint in endpoints])
+
+
+# Store an address under a name and add tags, groups and chain memberships to it
+def write_address(connection, address_name, address, tags=(), groups=(), chains=()):
+    connection.execute("INSERT INTO addresses (name, address) VALUES (?, ?) "
+                       "ON CONFLICT (name) DO UPDATE SET address = excluded.address", (address_name, address))
+    connection.executemany("INSERT OR IGNORE INTO address_tags (tag, address_name) VALUES (?, ?)",
+                           [(tag, address_name) for tag in tags])
+    connection.executemany("INSERT OR IGNORE INTO address_groups (group_name, address_name) VALUES (?, ?)",
+                           [(group_name, address_name) for group_name in groups])
+    connection.executemany("INSERT OR IGNORE INTO address_chains (address_name, chain) VALUES (?, ?)",
+                           [(address_name, chain) for chain in chains])
+
+
+# Load subgraph data from the registry.
+# A chain maps to one endpoint URL or to a list of endpoints serving the same subgraph, the first of
+# which names the chain in caches, and strategies map chain names to their position strategy.
+# Addresses map names to addresses, tags and address_chains map address names to their tags and
+# chain memberships, and groups map group names to their address names.
 def load_data():
-    if os.path.exists(storage_file):
-        with open(storage_file, 'r') as f:
-            return json.load(f)
-    else:
-        return {'subgraphs': {}, 'addresses': {}}
+    with registry_lock, contextlib.closing(open_registry()) as connection:
+        data = {'subgraphs': {}, 'strategies': {}, 'addresses': {}, 'tags': {}, 'groups': {}, 'address_chains': {}}
+        for subgraph_name, url, strategy in connection.execute(
+                "SELECT chain, url, strategy FROM endpoints JOIN chains ON chains.name = endpoints.chain "
+                "ORDER BY chains.rowid, endpoints.rowid"):
+            data['subgraphs'].setdefault(subgraph_name, []).append(url)
+            data['strategies'][subgraph_name] = strategy
+        for address_name, address in connection.execute("SELECT name, address FROM addresses ORDER BY rowid"):
+            data['addresses'][address_name] = address
+        for tag, address_name in connection.execute("SELECT tag, address_name FROM address_tags ORDER BY rowid"):
+            data['tags'].setdefault(address_name, []).append(tag)
+        for group_name, address_name in connection.execute(
+                "SELECT group_name, address_name FROM address_groups JOIN addresses ON addresses.name = address_name "
+                "ORDER BY group_name, addresses.rowid"):
+            data['groups'].setdefault(group_name, []).append(address_name)
+        for address_name, chain in connection.execute("SELECT address_name, chain FROM address_chains ORDER BY rowid"):
+            data['address_chains'].setdefault(address_name, []).append(chain)
+
+    for subgraph_name, endpoints in data['subgraphs'].items():
+        chain_strategies[endpoints[0]] = data['strategies'][subgraph_name]
+        if len(endpoints) > 1:
+            chain_endpoints[endpoints[0]] = endpoints
+        else:
+            data['subgraphs'][subgraph_name] = endpoints[0]
+    return data
+
+
+# URL identifying a stored chain: its endpoint, or the first of its endpoints
+def canonical_url(link):
+    return link[0] if isinstance(link, list) else link
+
+
+# Add (or change) a single chain in the subgraph data and the registry
+def add_chain(data, subgraph_name, link):
+    with registry_lock, contextlib.closing(open_registry()) as connection, connection:
+        write_chain(connection, subgraph_name, link if isinstance(link, list) else [link])
+    data['subgraphs'][subgraph_name] = link
+
+
+# Add a chain or replace a stored chain's endpoints, keeping its position strategy. The first endpoint
+# names the chain in caches, so changing it starts the chain's caches afresh.
+def set_endpoints(data, subgraph_name, endpoints):
+    link = endpoints if len(endpoints) > 1 else endpoints[0]
+    add_chain(data, subgraph_name, link)
+    data['strategies'].setdefault(subgraph_name, 'events')
+    chain_strategies[canonical_url(link)] = data['strategies'][subgraph_name]
+    if len(endpoints) > 1:
+        chain_endpoints[endpoints[0]] = endpoints
+
+
+# Set how a stored chain's positions are read ('events' or 'positions'). Returns False for unknown chains.
+def set_strategy(data, subgraph_name, strategy):
+    if subgraph_name not in data['subgraphs']:
+        print(f"Unknown chain: {subgraph_name}", file=sys.stderr)
+        return False
+
+    with registry_lock, contextlib.closing(open_registry()) as connection, connection:
+        connection.execute("UPDATE chains SET strategy = ? WHERE name = ?", (strategy, subgraph_name))
+    data['strategies'][subgraph_name] = strategy
+    chain_strategies[canonical_url(data['subgraphs'][subgraph_name])] = strategy
+    return True
+
+
+# Add (or change) a single address in the subgraph data and the registry
+def add_address(data, address_name, address, tags=()):
+    with registry_lock, contextlib.closing(open_registry()) as connection, connection:
+        write_address(connection, address_name, address, tags)
+    data['addresses'][address_name] = address
+    data.setdefault('tags', {}).setdefault(address_name, [])
+    data['tags'][address_name] += [tag for tag in tags if tag not in data['tags'][address_name]]
+
+
+# Import addresses from a CSV file with name and address columns and optional tags, groups and chains
+# columns (values separated by ';'), in one transaction. Existing names get the new address and the
+# added tags, groups and chain memberships.
+def import_addresses(path):
+    rows = []
+    with open(path, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        if not reader.fieldnames or not {'name', 'address'} <= set(reader.fieldnames):
+            print(f"{path} needs a header with name and address columns", file=sys.stderr)
+            return None
+        for line, row in enumerate(reader, start=2):
+            address_name = (row['name'] or '').strip()
+            address = (row['address'] or '').strip()
+            if not address_name or not address:
+                print(f"Skipping line {line} of {path}: missing name or address", file=sys.stderr)
+                continue
+            tags, groups, chains = ([value.strip() for value in (row.get(column) or '').split(';') if value.strip()]
+                                    for column in ('tags', 'groups', 'chains'))
+            rows.append((address_name, address, tags, groups, chains))
+
+    with registry_lock, contextlib.closing(open_registry()) as connection, connection:
+        for address_name, address, tags, groups, chains in rows:
+            write_address(connection, address_name, address, tags, groups, chains)
+    print(f"Imported {len(rows)} addresses from {path}")
+    return len(rows)
+
 
+# Return the (name, address) pairs tagged with a tag, in the order they were added
+def tagged_addresses(tag):
+    with registry_lock, contextlib.closing(open_registry()) as connection:
+        return connection.execute(
+            "SELECT addresses.name, addresses.address FROM address_tags "
+            "JOIN addresses ON addresses.name = address_tags.address_name "
+            "WHERE address_tags.tag = ? ORDER BY addresses.rowid", (tag,)).fetchall()
 
-# Save subgraph data to the file
-def save_data(data):
-    with open(storage_file, 'w') as f:
-        json.dump(data, f, indent=2)
+
+# Keep the addresses that are members of a chain; addresses without chain memberships belong to every chain
+def chain_addresses(data, subgraph_name, addresses):
+    memberships = data.get('address_chains', {})
+    return [(address_name, address) for address_name, address in addresses
+            if subgraph_name in memberships.get(address_name, [subgraph_name])]
 
 
 # Ask the user to select or add subgraphs
 def get_subgraphs(data):
     if data['subgraphs']:
+        import inquirer  # Only needed for interactive selection
+
         choices = list(data['subgraphs'].keys()) + ['New Subgraph']
 
         questions = [
@@ -39,11 +295,10 @@ def get_subgraphs(data):
                 if name.lower() == 'done':
                     break
                 link = input("Enter the GraphQL endpoint URL: ").strip()
-                data['subgraphs'][name] = link
-                save_data(data)
+                add_chain(data, name, link)
                 selected_subgraphs.append((name, link))
         else:
-            selected_subgraphs = [(name, data['subgraphs'][name]) for name in answers['subgraphs'] if
+            selected_subgraphs = [(name, canonical_url(data['subgraphs'][name])) for name in answers['subgraphs'] if
                                   name != 'New Subgraph']
 
         return selected_subgraphs
@@ -51,208 +306,2446 @@ def get_subgraphs(data):
         print("No subgraphs available. Please add a new one.")
         name = input("Enter a name for the new subgraph: ").strip()
         link = input("Enter the GraphQL endpoint URL: ").strip()
-        data['subgraphs'][name] = link
-        save_data(data)
+        add_chain(data, name, link)
         return [(name, link)]
 
 
-# Ask the user to select or add addresses for each subgraph
-def get_addresses(data, subgraph_name):
+# Ask the user to select or add addresses, once for all chains.
+# Stored groups are offered first; individual addresses are only listed when asked for.
+def get_addresses(data):
     if data['addresses']:
+        import inquirer  # Only needed for interactive selection
+
+        selected_addresses = []
+        if data['groups']:
+            groups = {f"Group: {group_name} ({len(members)} addresses)": group_name
+                      for group_name, members in data['groups'].items()}
+            question = [
+                inquirer.Checkbox('groups', message="Choose address groups",
+                                  choices=list(groups) + ['Individual Addresses'])
+            ]
+            answer = inquirer.prompt(question)
+
+            for choice in answer['groups']:
+                if choice in groups:
+                    selected_addresses += [(name, data['addresses'][name]) for name in data['groups'][groups[choice]]]
+            if 'Individual Addresses' not in answer['groups']:
+                return list(dict.fromkeys(selected_addresses))
+
         choices = [f"{name} ({address})" for name, address in data['addresses'].items()] + ['New Address']
 
         question = [
-            inquirer.Checkbox('addresses', message=f"Choose addresses for {subgraph_name}", choices=choices)
+            inquirer.Checkbox('addresses', message="Choose addresses", choices=choices)
         ]
         answer = inquirer.prompt(question)
 
-        selected_addresses = []
         if 'New Address' in answer['addresses']:
             while True:
                 name = input("Enter a name for the new address (or type 'done' to finish): ").strip()
                 if name.lower() == 'done':
                     break
                 address = input("Enter the Ethereum address: ").strip()
-                data['addresses'][name] = address
-                save_data(data)
+                add_address(data, name, address)
                 selected_addresses.append((name, address))
         else:
-            selected_addresses = [(name.split(' (')[0], name.split('(')[-1].strip(')')) for name in answer['addresses']
-                                  if name != 'New Address']
+            selected_addresses += [(name.split(' (')[0], name.split('(')[-1].strip(')')) for name in answer['addresses']
+                                   if name != 'New Address']
 
-        return selected_addresses
+        return list(dict.fromkeys(selected_addresses))
     else:
-        print(f"No addresses available. Please add a new one for {subgraph_name}.")
+        print("No addresses available. Please add a new one.")
         name = input("Enter a name for the new address: ").strip()
         address = input("Enter the Ethereum address: ").strip()
-        data['addresses'][name] = address
-        save_data(data)
+        add_address(data, name, address)
         return [(name, address)]
 
 
-# Perform GraphQL query for each chain and address
-def query_chain(subgraph_url, address):
-    query = f"""
-    {{
-      mints(where: {{ to: "{address}" }}) {{
-        id
-        liquidity
-        pair {{
-          id
-          token0 {{
-            symbol
-          }}
-          token1 {{
-            symbol
-          }}
-        }}
-        transaction {{
-          blockNumber
-          timestamp
-        }}
-      }}
-      burns(where: {{ sender: "{address}" }}) {{
+# Instrumentation: time spent per phase and running counters, aggregated across threads.
+# Set metrics_format to 'table', 'prometheus' or 'otlp' to report them at the end of a run,
+# into metrics_file or onto the console.
+metrics_format = None
+metrics_file = None
+metrics_started = time.time()
+phase_timings = {}  # phase -> [spans, total seconds, longest seconds]
+counters = {}  # (name, ((label, value), ...)) -> count
+metrics_lock = threading.Lock()
+
+
+# Add one timed span to a phase
+def record_span(phase, seconds):
+    with metrics_lock:
+        timing = phase_timings.setdefault(phase, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+
+# Time the enclosed block as a span of a phase
+@contextlib.contextmanager
+def span(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(phase, time.perf_counter() - started)
+
+
+# Decorator timing every call of a function as a span of a phase
+def timed(phase):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Add to a counter, optionally labelled (e.g. count('rows', 1000, entity='mints'))
+def count(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+# Maximum number of HTTP requests in flight, across all endpoints and per endpoint
+max_concurrent_requests = 16
+max_concurrent_per_endpoint = 4
+
+# Semaphores enforcing the limits above, created on first use
+request_slots = None
+endpoint_slots = {}
+slots_lock = threading.Lock()
+
+
+# Hold a request slot for the endpoint and one from the global pool
+@contextlib.contextmanager
+def request_slot(subgraph_url):
+    global request_slots
+    with slots_lock:
+        if request_slots is None:
+            request_slots = threading.BoundedSemaphore(max_concurrent_requests)
+        if subgraph_url not in endpoint_slots:
+            endpoint_slots[subgraph_url] = threading.BoundedSemaphore(max_concurrent_per_endpoint)
+        endpoint = endpoint_slots[subgraph_url]
+
+    with endpoint, request_slots:
+        yield
+
+
+# HTTP connections kept open per endpoint, and (connect, read) timeouts in seconds
+pool_size = 16
+request_timeout = (10, 120)
+
+# Session shared by every chain, created on first use
+session = None
+session_lock = threading.Lock()
+
+
+# Return the shared keep-alive session, with a connection pool per endpoint host
+def get_session():
+    global session
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=max(pool_size, max_concurrent_per_endpoint))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # Advertises gzip and deflate, plus brotli/zstd when urllib3 can decode them
+            session.headers.update(urllib3.util.make_headers(accept_encoding=True))
+        return session
+
+
+# Decode a JSON response body straight from its bytes, with orjson when it is installed
+@timed('decode')
+def decode_json(content):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+# Retries of a failed request: attempts after the first, and the cap of the exponential backoff in seconds.
+# Only connection errors, timeouts and these status codes are retried; a Retry-After header is honoured.
+max_retries = 4
+retry_base_delay = 0.5
+retry_max_delay = 30
+retry_statuses = {408, 429, 500, 502, 503, 504}
+
+# Circuit breakers: after this many consecutive failures an endpoint is skipped for breaker_cooldown
+# seconds, then a single request probes whether it has recovered
+breaker_threshold = 5
+breaker_cooldown = 30
+breakers = {}  # endpoint -> (consecutive failures, time the breaker opened or None)
+breakers_lock = threading.Lock()
+
+# Endpoints serving each chain with several, keyed by the chain's canonical URL. A request still
+# unanswered after hedge_delay seconds is also sent to the next endpoint, and the first answer wins.
+chain_endpoints = {}
+hedge_delay = 2.0
+endpoint_executor = None
+
+# Routing across a chain's endpoints: weight of the latest request in the smoothed latency and error
+# rate, seconds of routing cost added per unit of error rate, and how many blocks an endpoint may
+# trail the most advanced one before it is skipped
+latency_smoothing = 0.2
+error_penalty = 5.0
+max_lag_blocks = 20
+endpoint_stats = {}  # endpoint -> {'latency' (None until measured), 'errors', 'in_flight', 'block'}
+endpoint_stats_lock = threading.Lock()
+
+
+# Return the shared pool running hedged requests and endpoint probes
+def get_endpoint_executor():
+    global endpoint_executor
+    with slots_lock:
+        if endpoint_executor is None:
+            endpoint_executor = ThreadPoolExecutor(max_workers=4 * max_concurrent_requests)
+        return endpoint_executor
+
+
+# Return the measurements of an endpoint, creating them on first use. Call with endpoint_stats_lock held.
+def get_endpoint_stats(endpoint):
+    if endpoint not in endpoint_stats:
+        endpoint_stats[endpoint] = {'latency': None, 'errors': 0.0, 'in_flight': 0, 'block': None}
+    return endpoint_stats[endpoint]
+
+
+# Whether the endpoint's breaker is currently open, without claiming its probe
+def breaker_open(endpoint):
+    with breakers_lock:
+        opened_at = breakers.get(endpoint, (0, None))[1]
+        return opened_at is not None and time.time() - opened_at < breaker_cooldown
+
+
+# Whether a request may be sent to the endpoint now
+def breaker_allows(endpoint):
+    with breakers_lock:
+        failures, opened_at = breakers.get(endpoint, (0, None))
+        if opened_at is None:
+            return True
+        if time.time() - opened_at < breaker_cooldown:
+            return False
+
+        # Half open: this request probes the endpoint, the others wait another cooldown
+        breakers[endpoint] = (failures, time.time())
+        return True
+
+
+# Count a failed request against the endpoint's breaker, or reset it after a success,
+# and fold the outcome and the request's latency into the endpoint's routing measurements.
+# Failed requests count the time they took too, so an endpoint that times out looks slow.
+def record_outcome(endpoint, succeeded, latency=None):
+    with endpoint_stats_lock:
+        stats = get_endpoint_stats(endpoint)
+        stats['errors'] += latency_smoothing * ((0.0 if succeeded else 1.0) - stats['errors'])
+        if latency is not None:
+            if stats['latency'] is None:
+                stats['latency'] = latency
+            else:
+                stats['latency'] += latency_smoothing * (latency - stats['latency'])
+
+    with breakers_lock:
+        if succeeded:
+            breakers.pop(endpoint, None)
+            return
+
+        failures, opened_at = breakers.get(endpoint, (0, None))
+        failures += 1
+        breakers[endpoint] = (failures, time.time() if failures >= breaker_threshold else opened_at)
+
+
+# Seconds a response asks us to wait before retrying, or None
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# POST a request body to one endpoint, retrying transient failures with exponential backoff and full jitter.
+# Returns the decoded response, or None once the endpoint has failed for good.
+def send_with_retries(endpoint, body, description, retries=None):
+    retries = max_retries if retries is None else retries
+    for attempt in range(retries + 1):
+        if not breaker_allows(endpoint):
+            count('breaker_rejections', endpoint=endpoint)
+            print(f"Failed to fetch {description}. {endpoint} keeps failing and is skipped for now",
+                  file=sys.stderr)
+            return None
+
+        delay = None
+        started = None
+        with endpoint_stats_lock:
+            get_endpoint_stats(endpoint)['in_flight'] += 1
+        try:
+            queued = time.perf_counter()
+            with request_slot(endpoint):
+                started = time.perf_counter()
+                record_span('http.wait', started - queued)
+                response = get_session().post(endpoint, json=body, timeout=request_timeout)
+
+            # elapsed runs until the response headers arrived: the server's time plus a round trip.
+            # The rest of the request was spent downloading the body.
+            total = time.perf_counter() - started
+            server = min(response.elapsed.total_seconds(), total)
+            record_span('http.server', server)
+            record_span('http.transfer', total - server)
+            count('requests', endpoint=endpoint, status=response.status_code)
+            count('bytes_sent', len(response.request.body or b''))
+            count('bytes_received', len(response.content))
+
+            if response.status_code == 200:
+                response_json = decode_json(response.content)
+                record_outcome(endpoint, True, total)
+                return response_json
+        except (requests.RequestException, ValueError) as error:
+            failure = str(error)
+            count('request_errors', endpoint=endpoint)
+        else:
+            failure = f"Status code: {response.status_code}"
+            if response.status_code not in retry_statuses:
+                print(f"Failed to fetch {description}. {failure}", file=sys.stderr)
+                return None
+            delay = retry_after(response)
+
+        finally:
+            with endpoint_stats_lock:
+                get_endpoint_stats(endpoint)['in_flight'] -= 1
+
+        record_outcome(endpoint, False, time.perf_counter() - started if started is not None else None)
+        if attempt == retries:
+            print(f"Failed to fetch {description}. {failure}", file=sys.stderr)
+            return None
+
+        if delay is None:
+            delay = random.uniform(0, retry_base_delay * 2 ** attempt)
+        count('retries')
+        time.sleep(min(delay, retry_max_delay))
+
+
+# Order a chain's endpoints from best to worst. Endpoints trailing the most advanced one by more than
+# max_lag_blocks are left out unless all of them do; open breakers go last. The rest are ranked by
+# smoothed latency scaled up by requests already in flight, so load spreads to slower endpoints as the
+# fastest one fills up, plus error_penalty seconds per unit of recent error rate. Endpoints without
+# a measured latency are assumed to be as fast as the median of the chain's measured ones.
+def route_endpoints(subgraph_url):
+    endpoints = chain_endpoints.get(subgraph_url, [subgraph_url])
+    if len(endpoints) == 1:
+        return endpoints
+
+    with endpoint_stats_lock:
+        stats = {endpoint: dict(get_endpoint_stats(endpoint)) for endpoint in endpoints}
+
+    known_blocks = [endpoint_stat['block'] for endpoint_stat in stats.values() if endpoint_stat['block'] is not None]
+    if known_blocks:
+        current = [endpoint for endpoint in endpoints
+                   if stats[endpoint]['block'] is None or stats[endpoint]['block'] >= max(known_blocks) - max_lag_blocks]
+        endpoints = current or endpoints
+
+    measured = sorted(endpoint_stat['latency'] for endpoint_stat in stats.values()
+                      if endpoint_stat['latency'] is not None)
+    prior = measured[len(measured) // 2] if measured else 0.0
+
+    def cost(endpoint):
+        endpoint_stat = stats[endpoint]
+        latency = prior if endpoint_stat['latency'] is None else endpoint_stat['latency']
+        return (breaker_open(endpoint),
+                latency * (1 + endpoint_stat['in_flight']) + error_penalty * endpoint_stat['errors'])
+
+    return sorted(endpoints, key=cost)
+
+
+# POST a request body to a subgraph, routed to its best endpoint and hedged across the others.
+# The next endpoint is tried when the previous ones fail or stay silent for hedge_delay seconds.
+def send_hedged(subgraph_url, body, description):
+    endpoints = route_endpoints(subgraph_url)
+    if len(endpoints) == 1:
+        return send_with_retries(endpoints[0], body, description)
+
+    executor = get_endpoint_executor()
+    pending = set()
+    for endpoint in endpoints:
+        if pending:
+            count('hedged_requests')
+        pending.add(executor.submit(send_with_retries, endpoint, body, description))
+        done, pending = wait(pending, timeout=hedge_delay, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.result() is not None:
+                return future.result()
+
+    # Every endpoint has been tried; take the first of the slow ones to answer
+    for future in as_completed(pending):
+        if future.result() is not None:
+            return future.result()
+    return None
+
+
+# Automatic persisted queries: once an endpoint has accepted a document, later requests send only its
+# sha256 hash. Off by default, since graph-node itself does not support them; useful behind a gateway that does.
+persisted_queries = False
+persisted_documents = set()
+
+
+# Send a GraphQL document with its variables to a subgraph and return its data, or None if it failed
+def post_query(subgraph_url, query, description, variables=None):
+    body = {'query': query}
+    if variables:
+        body['variables'] = variables
+
+    document_hash = None
+    if persisted_queries:
+        document_hash = hashlib.sha256(query.encode()).hexdigest()
+        body['extensions'] = {'persistedQuery': {'version': 1, 'sha256Hash': document_hash}}
+        if (subgraph_url, document_hash) in persisted_documents:
+            del body['query']
+
+    response_json = send_hedged(subgraph_url, body, description)
+    if response_json is None:
+        return None
+
+    errors = response_json.get('errors')
+    if document_hash is not None:
+        # The endpoint forgot the document (or never had it); send it in full once more
+        if 'query' not in body and any(error.get('message') == 'PersistedQueryNotFound' for error in errors or []):
+            persisted_documents.discard((subgraph_url, document_hash))
+            return post_query(subgraph_url, query, description, variables)
+        persisted_documents.add((subgraph_url, document_hash))
+
+    # Partial data is not usable for totals, so any GraphQL error fails the query
+    if errors:
+        count('graphql_errors')
+        print(f"GraphQL errors fetching {description}: {'; '.join(error.get('message', '') for error in errors)}",
+              file=sys.stderr)
+        return None
+    return response_json.get('data')
+
+
+# Raised when a paginated query cannot be completed
+class QueryError(Exception):
+    pass
+
+
+# Rows requested per page, and how many fetched pages may wait for processing
+page_size = 1000
+max_pages_in_flight = 2
+
+# Marks the end of a paginated collection
+end_of_pages = object()
+
+
+# Walk an entity collection in id order, yielding one page (list of records built with record.from_row)
+# at a time. Pages are fetched in a background thread, at most max_pages_in_flight ahead of the consumer.
+# The document must take $first and $lastId (the id_gt cursor) besides the given variables.
+def paginate(subgraph_url, entity, document, variables, record, description):
+    pages = queue.Queue(maxsize=max_pages_in_flight)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_pages():
+        last_id = ""
+        while True:
+            page_variables = dict(variables, first=page_size, lastId=last_id)
+            result = post_query(subgraph_url, document, description, page_variables)
+            if result is None:
+                put(QueryError(f"Failed to fetch {description}"))
+                return
+
+            page = [record.from_row(row) for row in result[entity]]
+            count('rows', len(page), entity=entity)
+            if page and not put(page):
+                return
+            if len(page) < page_size:
+                put(end_of_pages)
+                return
+            last_id = page[-1].id
+
+    threading.Thread(target=fetch_pages, daemon=True).start()
+
+    def iterate_pages():
+        try:
+            while True:
+                with span('pages.wait'):
+                    page = pages.get()
+                if page is end_of_pages:
+                    return
+                if isinstance(page, QueryError):
+                    raise page
+                yield page
+        finally:
+            stopped.set()
+
+    # Also stop fetching when the pages are dropped without being read to the end, or at all
+    # (e.g. the burns of an address whose mints failed)
+    page_iterator = iterate_pages()
+    weakref.finalize(page_iterator, stopped.set)
+    return page_iterator
+
+
+# Records decoded from subgraph responses. Slotted dataclasses keep events small and attribute access fast;
+# amounts keep the subgraph's BigDecimal strings so either arithmetic can parse them.
+@dataclass(slots=True)
+class LiquidityEvent:
+    id: str
+    pair_id: str
+    token0_symbol: str
+    token1_symbol: str
+    liquidity: str
+    block_number: int
+    timestamp: int
+
+    # Build an event from a mint or burn row of a subgraph response
+    @classmethod
+    def from_row(cls, row):
+        pair = row['pair']
+        transaction = row['transaction']
+        return cls(row['id'], pair['id'], pair['token0']['symbol'], pair['token1']['symbol'], row['liquidity'],
+                   int(transaction['blockNumber']), int(transaction['timestamp']))
+
+
+@dataclass(slots=True)
+class Mint(LiquidityEvent):
+    pass
+
+
+@dataclass(slots=True)
+class Burn(LiquidityEvent):
+    pass
+
+
+@dataclass(slots=True)
+class Pair:
+    id: str
+    token0_id: str
+    token1_id: str
+    token0_symbol: str
+    token1_symbol: str
+    token0_decimals: int
+    token1_decimals: int
+    reserve0: str
+    reserve1: str
+    total_supply: str
+
+    # Build a pair from a pair row of a subgraph response
+    @classmethod
+    def from_row(cls, row):
+        token0, token1 = row['token0'], row['token1']
+        return cls(row['id'], token0['id'], token1['id'], token0['symbol'], token1['symbol'],
+                   int(token0.get('decimals') or 18),
+                   int(token1.get('decimals') or 18), row['reserve0'], row['reserve1'], row['totalSupply'])
+
+
+# Net LP token balance of one address in one pair
+@dataclass(slots=True)
+class Position:
+    pair_id: str
+    liquidity_minted: object = 0
+    liquidity_burned: object = 0
+
+    @property
+    def net_liquidity(self):
+        return self.liquidity_minted - self.liquidity_burned
+
+
+# Record type of each event collection
+event_records = {'mints': Mint, 'burns': Burn}
+
+
+# Current LP token balance of a user in a pair, read with the 'positions' strategy
+@dataclass(slots=True)
+class Balance:
+    id: str
+    user: str
+    pair_id: str
+    liquidity_token_balance: str
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['id'], row['user']['id'], row['pair']['id'], row['liquidityTokenBalance'])
+
+
+# Fields fetched for every mint and burn
+event_fields = """
         id
         liquidity
-        pair {{
+        pair {
           id
-          token0 {{
+          token0 {
             symbol
-          }}
-          token1 {{
+          }
+          token1 {
             symbol
-          }}
-        }}
-        transaction {{
+          }
+        }
+        transaction {
           blockNumber
           timestamp
-        }}
-      }}
-      pairs {{
-        id
-        token0 {{
-          symbol
-        }}
-        token1 {{
-          symbol
-        }}
-        reserve0
-        reserve1
-        totalSupply
+        }
+"""
+
+
+# Filter field that selects an address's rows in each event collection
+address_fields = {'mints': 'to', 'burns': 'sender'}
+
+
+# Arguments of one aliased mints or burns field and the variables they use. The suffix tells apart
+# the variables of different aliases in a batched document.
+def event_arguments(entity, after_block, pinned, suffix=""):
+    variables = [f"$address{suffix}: Bytes!", f"$lastId{suffix}: ID!"]
+    where = [f"{address_fields[entity]}: $address{suffix}", f"id_gt: $lastId{suffix}"]
+    if after_block:
+        variables.append(f"$afterBlock{suffix}: BigInt!")
+        where.append(f"transaction_: {{ blockNumber_gt: $afterBlock{suffix} }}")
+
+    block_argument = "block: { number: $block }, " if pinned else ""
+    arguments = f"{block_argument}first: $first, orderBy: id, orderDirection: asc, where: {{ {', '.join(where)} }}"
+    return arguments, variables
+
+
+# Build the document for one page of an address's mints or burns, optionally limited to events
+# after $afterBlock and pinned to $block
+def event_page_document(entity, after_block, pinned):
+    arguments, variables = event_arguments(entity, after_block, pinned)
+    variables = ["$first: Int!"] + variables + (["$block: Int!"] if pinned else [])
+    return f"""
+    query {entity.capitalize()}Page({', '.join(variables)}) {{
+      {entity}({arguments}) {{
+        {event_fields.strip()}
       }}
     }}
     """
 
-    response = requests.post(subgraph_url, json={'query': query})
 
-    if response.status_code == 200:
-        return response.json().get('data')
+# Every page document, built once and reused for every address with different variables
+event_page_documents = {(entity, after_block, pinned): event_page_document(entity, after_block, pinned)
+                        for entity in address_fields for after_block in (False, True) for pinned in (False, True)}
+
+
+# Variables selecting one address's events, optionally after a block and pinned to a block
+def event_variables(address, after_block, block):
+    variables = {'address': address}
+    if after_block:
+        variables['afterBlock'] = str(after_block)
+    if block is not None:
+        variables['block'] = block
+    return variables
+
+
+# Perform GraphQL query for each chain and address (phase one: mints and burns only).
+# Rows are returned lazily and streamed page by page while they are consumed.
+def query_chain(subgraph_url, address, after_block=0, block=None):
+    variables = event_variables(address, after_block, block)
+    mint_pages = paginate(subgraph_url, 'mints', event_page_documents[('mints', bool(after_block), block is not None)],
+                          variables, Mint, f"mints for {address}")
+    burn_pages = paginate(subgraph_url, 'burns', event_page_documents[('burns', bool(after_block), block is not None)],
+                          variables, Burn, f"burns for {address}")
+
+    return {
+        'mints': itertools.chain.from_iterable(mint_pages),
+        'burns': itertools.chain.from_iterable(burn_pages),
+    }
+
+
+# How each chain's positions are read, by canonical URL. 'events' sums mints(where: {to}) minus
+# burns(where: {sender}) over the address's history; 'positions' reads the current balances of
+# Uniswap-V2-style LiquidityPosition entities, which also counts LP tokens that arrived by transfer and
+# costs one row per open position. Chains missing here use 'events'.
+position_strategies = ['events', 'positions']
+chain_strategies = {}
+
+# Document for one page of the open liquidity positions of $users, at the head or as of block $block
+liquidity_positions_document = """
+query LiquidityPositionsPage($users: [String!]!, $first: Int!, $lastId: ID!) {
+  liquidityPositions(first: $first, orderBy: id, orderDirection: asc,
+                     where: { user_in: $users, liquidityTokenBalance_gt: "0", id_gt: $lastId }) {
+    id
+    user {
+      id
+    }
+    pair {
+      id
+    }
+    liquidityTokenBalance
+  }
+}
+"""
+pinned_liquidity_positions_document = (
+    liquidity_positions_document.replace("$lastId: ID!)", "$lastId: ID!, $block: Int!)")
+    .replace("liquidityPositions(first:", "liquidityPositions(block: { number: $block }, first:"))
+
+
+# Summarize the open positions of addresses on a chain from their LiquidityPosition balances, in one
+# paginated query for all of them. Returns one summary per address, like summarize_liquidity;
+# a position's balance is its minted liquidity. Raises QueryError if a page cannot be fetched.
+def query_positions(subgraph_url, addresses, block=None):
+    variables = {'users': [address.lower() for address in addresses]}
+    if block is not None:
+        variables['block'] = block
+    pages = paginate(subgraph_url, 'liquidityPositions',
+                     liquidity_positions_document if block is None else pinned_liquidity_positions_document,
+                     variables, Balance, f"liquidity positions for {len(addresses)} addresses")
+
+    address_summaries = {address.lower(): {} for address in addresses}
+    with span('process'):
+        for balance in itertools.chain.from_iterable(pages):
+            address_summary = address_summaries.get(balance.user.lower())
+            if address_summary is not None:
+                address_summary[balance.pair_id] = Position(balance.pair_id,
+                                                            parse_liquidity(balance.liquidity_token_balance))
+    return [address_summaries[address.lower()] for address in addresses]
+
+
+# Batch mode: query the mints and burns of many addresses in one aliased document.
+# Each document holds at most batch_max_aliases collections and batch_max_query_bytes of text.
+batch_addresses = False
+batch_max_aliases = 50
+batch_max_query_bytes = 64 * 1024
+
+
+# Build the aliased document for one batch round: field i is the given entity for the address in
+# $address<i>, aliased m<i> or b<i>. Documents are cached by the sequence of entities they hold.
+@functools.lru_cache(maxsize=256)
+def batch_document(entities, after_block, pinned):
+    compact_fields = " ".join(event_fields.split())
+    variables = ["$first: Int!"] + (["$block: Int!"] if pinned else [])
+    fields = []
+
+    for position, entity in enumerate(entities):
+        arguments, field_variables = event_arguments(entity, after_block, pinned, position)
+        variables.extend(field_variables)
+        fields.append(f"{entity[0]}{position}: {entity}({arguments}) {{ {compact_fields} }}")
+
+    return f"query Batch({', '.join(variables)}) {{\n" + "\n".join(fields) + "\n}"
+
+
+# Perform GraphQL query for many addresses on one chain using aliases (m0: mints, b0: burns, ...).
+# Collections that fill a page are continued in the next round from their last id.
+def query_chain_batch(subgraph_url, addresses, after_blocks=None, block=None):
+    results = [{'mints': [], 'burns': []} for _ in addresses]
+    after_blocks = after_blocks or [0] * len(addresses)
+    after_block, pinned = any(after_blocks), block is not None
+
+    # Collections per document, within both the alias and the size budget
+    alias_bytes = len(batch_document(('mints',), after_block, pinned)) + 2 * max(map(len, addresses), default=0) + 64
+    batch_limit = max(1, min(batch_max_aliases, batch_max_query_bytes // alias_bytes))
+
+    # Each cursor is (entity, address index, last id seen)
+    cursors = [(entity, index, "") for index in range(len(addresses)) for entity in address_fields]
+
+    while cursors:
+        batch, cursors = cursors[:batch_limit], cursors[batch_limit:]
+        document = batch_document(tuple(entity for entity, index, last_id in batch), after_block, pinned)
+
+        variables = {'first': page_size}
+        if pinned:
+            variables['block'] = block
+        for position, (entity, index, last_id) in enumerate(batch):
+            variables[f'address{position}'] = addresses[index]
+            variables[f'lastId{position}'] = last_id
+            if after_block:
+                variables[f'afterBlock{position}'] = str(after_blocks[index])
+
+        result = post_query(subgraph_url, document, f"batch of {len(batch)} collections from {subgraph_url}",
+                            variables)
+        if result is None:
+            raise QueryError(f"Failed to fetch batched data from {subgraph_url}")
+
+        # Demultiplex the aliased response back into per-address results
+        for position, (entity, index, last_id) in enumerate(batch):
+            page = [event_records[entity].from_row(row) for row in result[f'{entity[0]}{position}']]
+            count('rows', len(page), entity=entity)
+            results[index][entity].extend(page)
+            if len(page) == page_size:
+                cursors.append((entity, index, page[-1].id))
+
+    return results
+
+
+# Arithmetic used for liquidity and token amounts: 'float' parses BigDecimal strings with float(),
+# 'exact' parses them once into integers scaled by 10 ** amount_decimals
+arithmetic = 'float'
+amount_decimals = 18
+lp_token_decimals = 18
+
+
+# Parse a BigDecimal string into an integer scaled by 10 ** decimals, truncating extra digits
+def parse_units(value, decimals):
+    if 'e' in value or 'E' in value:
+        return int((Decimal(value).scaleb(decimals)).to_integral_value(ROUND_DOWN))
+
+    whole, _, fraction = value.partition('.')
+    digits = whole + (fraction + '0' * decimals)[:decimals]
+    return int(digits) if digits.strip('-') else 0
+
+
+# Format an integer scaled by 10 ** decimals as a plain decimal string
+def format_units(amount, decimals=amount_decimals):
+    sign = '-' if amount < 0 else ''
+    whole, fraction = divmod(abs(amount), 10 ** decimals)
+    fraction = str(fraction).rjust(decimals, '0').rstrip('0')
+    return f"{sign}{whole}.{fraction}" if fraction else f"{sign}{whole}"
+
+
+# Parse an LP token amount (liquidity, totalSupply) with the selected arithmetic
+def parse_liquidity(value):
+    return parse_units(value, lp_token_decimals) if arithmetic == 'exact' else float(value)
+
+
+# Parse a token reserve with the selected arithmetic. Exact amounts are parsed at the token's own
+# decimals and rescaled to amount_decimals so tokens with different decimals can be added up.
+def parse_reserve(value, decimals):
+    if arithmetic != 'exact':
+        return float(value)
+
+    amount = parse_units(value, decimals)
+    if decimals <= amount_decimals:
+        return amount * 10 ** (amount_decimals - decimals)
+    return amount // 10 ** (decimals - amount_decimals)
+
+
+# Display form of a token total
+def format_amount(total):
+    return format_units(total) if isinstance(total, int) else total
+
+
+# Local cache of mints and burns already fetched, and the net-liquidity ledger built from them,
+# kept next to the storage file. Set to None to fetch and sum the full history on every run.
+cache_file = "subgraph_cache.db"
+cache_lock = threading.Lock()
+cache_ready = False
+
+# Seconds a chain's head (and a block's hash) is reused before asking the subgraph again
+head_max_age = 10
+chain_heads = {}
+head_locks = {}
+block_hashes = {}
+
+# Blocks rolled back when an address's watermark block turns out to have been reorged
+reorg_depth = 64
+
+
+# Open the cache database, creating its tables on first use
+def open_cache():
+    global cache_ready
+    connection = sqlite3.connect(cache_file, timeout=30)
+    if not cache_ready:
+        # Ledgers written before exact arithmetic held floats; they are rebuilt from the cached events
+        ledger_types = {column[1]: column[2] for column in connection.execute("PRAGMA table_info(positions)")}
+        rebuild_ledger = ledger_types.get('liquidity_minted') == 'REAL'
+        if rebuild_ledger:
+            connection.execute("DROP TABLE positions")
+
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS events (
+                subgraph_url TEXT NOT NULL,
+                address TEXT NOT NULL,
+                entity TEXT NOT NULL,
+                id TEXT NOT NULL,
+                pair_id TEXT NOT NULL,
+                token0_symbol TEXT,
+                token1_symbol TEXT,
+                liquidity TEXT NOT NULL,
+                block_number INTEGER NOT NULL,
+                timestamp INTEGER NOT NULL,
+                PRIMARY KEY (subgraph_url, address, entity, id)
+            );
+            CREATE TABLE IF NOT EXISTS watermarks (
+                subgraph_url TEXT NOT NULL,
+                address TEXT NOT NULL,
+                block_number INTEGER NOT NULL,
+                PRIMARY KEY (subgraph_url, address)
+            );
+            CREATE TABLE IF NOT EXISTS pair_states (
+                subgraph_url TEXT NOT NULL,
+                pair_id TEXT NOT NULL,
+                pair TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (subgraph_url, pair_id)
+            );
+            CREATE TABLE IF NOT EXISTS positions (
+                subgraph_url TEXT NOT NULL,
+                address TEXT NOT NULL,
+                pair_id TEXT NOT NULL,
+                liquidity_minted TEXT NOT NULL,
+                liquidity_burned TEXT NOT NULL,
+                PRIMARY KEY (subgraph_url, address, pair_id)
+            );
+        """)
+
+        # Caches written before reorg detection have no block hash column
+        columns = [column[1] for column in connection.execute("PRAGMA table_info(watermarks)")]
+        if 'block_hash' not in columns:
+            connection.execute("ALTER TABLE watermarks ADD COLUMN block_hash TEXT")
+            connection.commit()
+
+        if rebuild_ledger:
+            with connection:
+                rows = connection.execute("SELECT subgraph_url, address, pair_id, entity, liquidity FROM events")
+                for subgraph_url, address, pair_id, entity, liquidity in rows.fetchall():
+                    adjust_position(connection, subgraph_url, address, pair_id, entity, liquidity)
+        cache_ready = True
+    return connection
+
+
+# Return the block (and its hash) up to which an address's ledger is complete
+def load_watermark(subgraph_url, address):
+    with cache_lock, contextlib.closing(open_cache()) as connection:
+        row = connection.execute(
+            "SELECT block_number, block_hash FROM watermarks WHERE subgraph_url = ? AND address = ?",
+            (subgraph_url, address.lower())).fetchone()
+    return row if row else (0, None)
+
+
+# Return an address's net-liquidity ledger as Positions keyed by pair id, like summarize_liquidity.
+# The ledger holds exact LP token amounts; they are converted to floats unless arithmetic is exact.
+def load_positions(subgraph_url, address):
+    with cache_lock, contextlib.closing(open_cache()) as connection:
+        rows = connection.execute(
+            "SELECT pair_id, liquidity_minted, liquidity_burned FROM positions WHERE subgraph_url = ? AND address = ?",
+            (subgraph_url, address.lower())).fetchall()
+
+    convert = int if arithmetic == 'exact' else lambda amount: int(amount) / 10 ** lp_token_decimals
+    return {pair_id: Position(pair_id, convert(minted), convert(burned)) for pair_id, minted, burned in rows}
+
+
+# Add a single event's liquidity (a BigDecimal string) to the ledger, or remove it with sign -1
+def adjust_position(connection, subgraph_url, address, pair_id, entity, liquidity, sign=1):
+    amount = sign * parse_units(liquidity, lp_token_decimals)
+    row = connection.execute(
+        "SELECT liquidity_minted, liquidity_burned FROM positions WHERE subgraph_url = ? AND address = ? AND pair_id = ?",
+        (subgraph_url, address, pair_id)).fetchone()
+    minted, burned = (int(row[0]), int(row[1])) if row else (0, 0)
+
+    if entity == 'mints':
+        minted += amount
     else:
-        print(f"Failed to fetch data for {address}. Status code: {response.status_code}")
+        burned += amount
+    connection.execute("INSERT OR REPLACE INTO positions VALUES (?, ?, ?, ?, ?)",
+                       (subgraph_url, address, pair_id, str(minted), str(burned)))
+
+
+# Store newly fetched mints and burns, apply the ones not seen before to the ledger and move the
+# watermark, all in one transaction. Returns the updated ledger.
+@timed('cache')
+def apply_new_events(subgraph_url, address, events, head, head_hash):
+    address = address.lower()
+    rows = [(entity, event.id, event.pair_id, event.token0_symbol, event.token1_symbol, event.liquidity,
+             event.block_number, event.timestamp)
+            for entity in address_fields for event in events[entity]]
+
+    with cache_lock, contextlib.closing(open_cache()) as connection, connection:
+        for entity, event_id, pair_id, token0_symbol, token1_symbol, liquidity, block_number, timestamp in rows:
+            inserted = connection.execute(
+                "INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (subgraph_url, address, entity, event_id, pair_id, token0_symbol, token1_symbol, liquidity,
+                 block_number, timestamp)).rowcount
+            if inserted:
+                adjust_position(connection, subgraph_url, address, pair_id, entity, liquidity)
+
+        connection.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)",
+                           (subgraph_url, address, head, head_hash))
+
+    return load_positions(subgraph_url, address)
+
+
+# Undo every cached event of an address above the given block and move its watermark back there
+def rollback_positions(subgraph_url, address, block_number):
+    address = address.lower()
+    with cache_lock, contextlib.closing(open_cache()) as connection, connection:
+        rows = connection.execute(
+            "SELECT entity, pair_id, liquidity FROM events "
+            "WHERE subgraph_url = ? AND address = ? AND block_number > ?",
+            (subgraph_url, address, block_number)).fetchall()
+        for entity, pair_id, liquidity in rows:
+            adjust_position(connection, subgraph_url, address, pair_id, entity, liquidity, -1)
+
+        connection.execute("DELETE FROM events WHERE subgraph_url = ? AND address = ? AND block_number > ?",
+                           (subgraph_url, address, block_number))
+        connection.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, NULL)",
+                           (subgraph_url, address, block_number))
+
+
+# Documents asking for the latest indexed block, and for the hash of block $number
+head_document = "query Head { _meta { block { number hash } } }"
+block_hash_document = "query BlockHash($number: Int!) { _meta(block: { number: $number }) { block { hash } } }"
+
+
+# Return the chain's latest indexed block number and hash, reusing a recent answer
+def get_chain_head(subgraph_url):
+    with slots_lock:
+        head_lock = head_locks.setdefault(subgraph_url, threading.Lock())
+
+    with head_lock:
+        head = chain_heads.get(subgraph_url)
+        if head and time.time() - head[2] < head_max_age:
+            return head[0], head[1]
+
+        if subgraph_url in chain_endpoints:
+            block = probe_endpoints(subgraph_url)
+        else:
+            result = post_query(subgraph_url, head_document, f"head block of {subgraph_url}")
+            block = result['_meta']['block'] if result is not None else None
+        if block is None:
+            raise QueryError(f"Failed to fetch the head block of {subgraph_url}")
+
+        chain_heads[subgraph_url] = (block['number'], block['hash'], time.time())
+        return block['number'], block['hash']
+
+
+# Ask one endpoint for the block it has indexed up to, recording it for routing
+def probe_endpoint(endpoint):
+    response_json = send_with_retries(endpoint, {'query': head_document}, f"head block of {endpoint}", 0)
+    if response_json is None or response_json.get('errors'):
         return None
 
+    block = response_json['data']['_meta']['block']
+    with endpoint_stats_lock:
+        get_endpoint_stats(endpoint)['block'] = block['number']
+    return block
+
+
+# Probe every endpoint of a chain and return the head they can all serve: the lowest block among
+# the endpoints within max_lag_blocks of the most advanced one, so that block-pinned queries
+# succeed wherever they are routed
+def probe_endpoints(subgraph_url):
+    blocks = [block for block in get_endpoint_executor().map(probe_endpoint, chain_endpoints[subgraph_url])
+              if block is not None]
+    if not blocks:
+        return None
+
+    highest = max(block['number'] for block in blocks)
+    return min((block for block in blocks if block['number'] >= highest - max_lag_blocks),
+               key=lambda block: block['number'])
+
+
+# Return the hash the subgraph currently has for a block number, reusing a recent answer
+def get_block_hash(subgraph_url, block_number):
+    with slots_lock:
+        head_lock = head_locks.setdefault(subgraph_url, threading.Lock())
+
+    with head_lock:
+        known = block_hashes.get((subgraph_url, block_number))
+        if known and time.time() - known[1] < head_max_age:
+            return known[0]
+
+        result = post_query(subgraph_url, block_hash_document, f"hash of block {block_number} from {subgraph_url}",
+                            {'number': block_number})
+        if result is None:
+            raise QueryError(f"Failed to fetch the hash of block {block_number} from {subgraph_url}")
+
+        block_hashes[(subgraph_url, block_number)] = (result['_meta']['block']['hash'], time.time())
+        return result['_meta']['block']['hash']
 
-# Process data for a single address and chain
-def process_data(data, address, address_totals):
-    mints = data['mints']
-    burns = data['burns']
-    pairs = data['pairs']
 
-    # Dictionary to store the net LP token amounts per pair
+# Return the block after which an address needs new events, rolling its ledger back first
+# if the block it was last updated at is no longer on the indexed chain
+def check_reorg(subgraph_url, address):
+    watermark, block_hash = load_watermark(subgraph_url, address)
+    if watermark and block_hash and get_block_hash(subgraph_url, watermark) != block_hash:
+        print(f"Block {watermark} on {subgraph_url} was reorged; rolling {address} back {reorg_depth} blocks",
+              file=sys.stderr)
+        watermark = max(0, watermark - reorg_depth)
+        rollback_positions(subgraph_url, address, watermark)
+    return watermark
+
+
+# Bring an address's ledger up to the chain head by fetching and applying only events after its watermark
+def update_address_positions(subgraph_url, address):
+    head, head_hash = get_chain_head(subgraph_url)
+    watermark = check_reorg(subgraph_url, address)
+    events = query_chain(subgraph_url, address, watermark, head)
+    return apply_new_events(subgraph_url, address, events, head, head_hash)
+
+
+# Batched counterpart of update_address_positions
+def update_batch_positions(subgraph_url, addresses):
+    head, head_hash = get_chain_head(subgraph_url)
+    watermarks = [check_reorg(subgraph_url, address) for address in addresses]
+    results = query_chain_batch(subgraph_url, addresses, watermarks, head)
+    return [apply_new_events(subgraph_url, address, events, head, head_hash)
+            for address, events in zip(addresses, results)]
+
+
+# Return an address's cached mints and burns up to a block, or None unless the cache is complete that far
+def load_cached_events(subgraph_url, address, block_number):
+    if cache_file is None or load_watermark(subgraph_url, address)[0] < block_number:
+        return None
+
+    events = {entity: [] for entity in address_fields}
+    with cache_lock, contextlib.closing(open_cache()) as connection:
+        rows = connection.execute(
+            "SELECT entity, id, pair_id, token0_symbol, token1_symbol, liquidity, block_number, timestamp "
+            "FROM events WHERE subgraph_url = ? AND address = ? AND block_number <= ? ORDER BY entity, id",
+            (subgraph_url, address.lower(), block_number)).fetchall()
+
+    for entity, *fields in rows:
+        events[entity].append(event_records[entity](*fields))
+    return events
+
+
+# Summarize an address's position as of a past block, from the cache when it reaches that block and
+# from a block-pinned query otherwise
+def snapshot_summary(subgraph_url, address, block_number):
+    events = load_cached_events(subgraph_url, address, block_number)
+    if events is None:
+        events = query_chain(subgraph_url, address, 0, block_number)
+    return summarize_liquidity(events)
+
+
+# Document finding the block of the last transaction at or before $timestamp
+block_at_timestamp_document = """
+query BlockAtTimestamp($timestamp: BigInt!) {
+  transactions(first: 1, orderBy: timestamp, orderDirection: desc, where: { timestamp_lte: $timestamp }) {
+    blockNumber
+  }
+}
+"""
+
+
+# Return the block of a chain's last indexed transaction at or before a unix timestamp.
+# Pool state only changes with transactions, so positions at that block are positions at that time.
+def block_at_timestamp(subgraph_url, timestamp):
+    result = post_query(subgraph_url, block_at_timestamp_document, f"block at {timestamp} from {subgraph_url}",
+                        {'timestamp': str(timestamp)})
+    if result is None:
+        raise QueryError(f"Failed to find the block at {timestamp} on {subgraph_url}")
+    transactions = result['transactions']
+    return int(transactions[0]['blockNumber']) if transactions else None
+
+
+# Maximum number of pair ids sent in a single id_in filter
+pairs_chunk_size = 100
+
+
+# Documents fetching the reserves and supply of the pairs in $ids, at the head or as of block $block
+pairs_document = """
+query Pairs($ids: [ID!]!, $first: Int!) {
+  pairs(first: $first, where: { id_in: $ids }) {
+    id
+    token0 {
+      id
+      symbol
+      decimals
+    }
+    token1 {
+      id
+      symbol
+      decimals
+    }
+    reserve0
+    reserve1
+    totalSupply
+  }
+}
+"""
+pinned_pairs_document = (pairs_document.replace("$first: Int!)", "$first: Int!, $block: Int!)")
+                         .replace("pairs(first:", "pairs(block: { number: $block }, first:"))
+
+
+# Fetch reserves and supply for the given pairs only (phase two), optionally as of a past block
+def query_pairs(subgraph_url, pair_ids, block=None):
+    pair_ids = sorted(pair_ids)
+    pairs = []
+
+    for start in range(0, len(pair_ids), pairs_chunk_size):
+        chunk = pair_ids[start:start + pairs_chunk_size]
+        if block is None:
+            document, variables = pairs_document, {'ids': chunk, 'first': len(chunk)}
+        else:
+            document, variables = pinned_pairs_document, {'ids': chunk, 'first': len(chunk), 'block': block}
+
+        result = post_query(subgraph_url, document, f"pairs from {subgraph_url}", variables)
+        if result is None:
+            return None
+        pairs.extend(Pair.from_row(row) for row in result['pairs'])
+        count('rows', len(result['pairs']), entity='pairs')
+
+    return pairs
+
+
+# Pair reserves and supply younger than pair_max_staleness seconds are reused instead of refetched.
+# At most pair_cache_size pairs are kept in memory (least recently used evicted first); with the
+# cache file enabled they are also kept on disk between runs. In service mode, pairs fetched before
+# a chain's head last moved are refetched however young, so reserve changes show at the new head.
+pair_max_staleness = 30
+pair_cache_size = 10000
+pair_cache = OrderedDict()
+pair_refetch_after = {}
+pair_cache_lock = threading.Lock()
+
+
+# Return the given pairs, served from the pair cache where fresh enough and fetched otherwise.
+# Pairs as of a past block never change, so they are reused regardless of age (in memory only).
+def get_pairs(subgraph_url, pair_ids, block=None):
+    now = time.time()
+    oldest = max(now - pair_max_staleness, pair_refetch_after.get(subgraph_url, 0))
+    pairs = []
+    missing = set()
+
+    with pair_cache_lock:
+        for pair_id in pair_ids:
+            cached = pair_cache.get((subgraph_url, pair_id, block))
+            if cached and (block is not None or cached[1] >= oldest):
+                pair_cache.move_to_end((subgraph_url, pair_id, block))
+                pairs.append(cached[0])
+            else:
+                missing.add(pair_id)
+    count('pair_cache_hits', len(pairs), cache='memory')
+
+    fetched = []
+    if missing and cache_file is not None and block is None:
+        missing_ids = sorted(missing)
+        with cache_lock, contextlib.closing(open_cache()) as connection:
+            for start in range(0, len(missing_ids), pairs_chunk_size):
+                chunk = missing_ids[start:start + pairs_chunk_size]
+                rows = connection.execute(
+                    "SELECT pair, fetched_at FROM pair_states WHERE subgraph_url = ? AND fetched_at >= ? "
+                    f"AND pair_id IN ({', '.join('?' * len(chunk))})",
+                    (subgraph_url, oldest, *chunk)).fetchall()
+                for pair, fetched_at in rows:
+                    pair = json.loads(pair)
+                    # Pairs cached by earlier versions lack token addresses and are fetched again
+                    if 'token0_id' not in pair:
+                        continue
+                    pair = Pair(**pair)
+                    missing.discard(pair.id)
+                    fetched.append((pair, fetched_at))
+        count('pair_cache_hits', len(fetched), cache='disk')
+
+    if missing:
+        queried = query_pairs(subgraph_url, missing, block)
+        if queried is None:
+            return None
+
+        fetched_at = time.time()
+        if cache_file is not None and block is None:
+            with cache_lock, contextlib.closing(open_cache()) as connection, connection:
+                connection.executemany("INSERT OR REPLACE INTO pair_states VALUES (?, ?, ?, ?)",
+                                       [(subgraph_url, pair.id, json.dumps(asdict(pair)), fetched_at)
+                                        for pair in queried])
+        fetched.extend((pair, fetched_at) for pair in queried)
+
+    with pair_cache_lock:
+        for pair, fetched_at in fetched:
+            pair_cache[(subgraph_url, pair.id, block)] = (pair, fetched_at)
+            pair_cache.move_to_end((subgraph_url, pair.id, block))
+        while len(pair_cache) > pair_cache_size:
+            pair_cache.popitem(last=False)
+
+    # Id order keeps float totals identical however the pairs were split between cache and query
+    return sorted(pairs + [pair for pair, fetched_at in fetched], key=lambda pair: pair.id)
+
+
+# Valuation of token totals in USD. price_source is None (no valuation), 'subgraph' (each token's
+# derivedETH times the bundle's ethPrice) or the path of a JSON price file. Prices are looked up
+# once per chain for all of its tokens and reused for price_ttl seconds.
+price_source = None
+price_ttl = 300
+price_cache = {}  # (subgraph_url, block, token address) -> (price or None, time fetched)
+price_cache_lock = threading.Lock()
+
+# Document fetching the ETH price and the ETH value of the tokens in $ids, at the head or as of block $block
+token_prices_document = """
+query TokenPrices($ids: [ID!]!, $first: Int!) {
+  bundle(id: "1") {
+    ethPrice
+  }
+  tokens(first: $first, where: { id_in: $ids }) {
+    id
+    derivedETH
+  }
+}
+"""
+pinned_token_prices_document = (token_prices_document.replace("$first: Int!)", "$first: Int!, $block: Int!)")
+                                .replace('bundle(id: "1")', 'bundle(id: "1", block: { number: $block })')
+                                .replace("tokens(first:", "tokens(block: { number: $block }, first:"))
+
+
+# Token prices from the subgraph's own pricing, or None if the query failed
+def subgraph_prices(subgraph_name, subgraph_url, token_ids, block):
+    prices = {}
+    for start in range(0, len(token_ids), pairs_chunk_size):
+        chunk = token_ids[start:start + pairs_chunk_size]
+        variables = {'ids': chunk, 'first': len(chunk)}
+        if block is not None:
+            variables['block'] = block
+
+        result = post_query(subgraph_url, token_prices_document if block is None else pinned_token_prices_document,
+                            f"token prices from {subgraph_url}", variables)
+        if result is None:
+            return None
+        if result['bundle'] is None:
+            print(f"{subgraph_name} has no ETH price bundle; its tokens are not valued", file=sys.stderr)
+            return {}
+
+        eth_price = float(result['bundle']['ethPrice'])
+        prices.update((token['id'], float(token['derivedETH']) * eth_price) for token in result['tokens'])
+    return prices
+
+
+# Token prices from the price file, which maps "<chain>:<token address>" or "<token address>" to a USD price.
+# Returns None if the file cannot be read.
+def file_prices(subgraph_name, subgraph_url, token_ids, block):
+    try:
+        with open(price_source, 'r') as f:
+            table = {key.lower(): value for key, value in json.load(f).items()}
+    except (OSError, ValueError) as error:
+        print(f"Failed to read prices from {price_source}. {error}", file=sys.stderr)
+        return None
+
+    prices = {}
+    for token_id in token_ids:
+        for key in (f"{subgraph_name}:{token_id}".lower(), token_id.lower()):
+            if key in table:
+                prices[token_id] = float(table[key])
+                break
+    return prices
+
+
+# USD prices of the given tokens of a chain, served from the price cache where fresh enough.
+# Tokens without a known price are left out.
+def get_prices(subgraph_name, subgraph_url, token_ids, block=None):
+    now = time.time()
+    prices = {}
+    missing = []
+
+    with price_cache_lock:
+        for token_id in token_ids:
+            cached = price_cache.get((subgraph_url, block, token_id))
+            if cached and (block is not None or now - cached[1] < price_ttl):
+                prices[token_id] = cached[0]
+            else:
+                missing.append(token_id)
+
+    if missing:
+        source = subgraph_prices if price_source == 'subgraph' else file_prices
+        fetched = source(subgraph_name, subgraph_url, sorted(missing), block)
+        count('price_lookups', len(missing))
+        if fetched is not None:
+            with price_cache_lock:
+                for token_id in missing:
+                    prices[token_id] = fetched.get(token_id)
+                    price_cache[(subgraph_url, block, token_id)] = (prices[token_id], now)
+
+    return {token_id: price for token_id, price in prices.items() if price is not None}
+
+
+# Fetch a chain's pairs and, when valuing, the prices of their tokens (phase two).
+# Returns the pairs (None if they could not be fetched) and the prices.
+def fetch_market(subgraph_name, subgraph_url, pair_ids, block=None):
+    pairs = get_pairs(subgraph_url, pair_ids, block)
+    if pairs is None or price_source is None:
+        return pairs, {}
+
+    token_ids = {pair.token0_id for pair in pairs} | {pair.token1_id for pair in pairs}
+    return pairs, get_prices(subgraph_name, subgraph_url, token_ids, block)
+
+
+# Engine used for position math: 'python' loops over dicts, 'numpy' works on whole columns
+numeric_engine = 'python'
+
+
+# Sum minted and burned LP tokens per pair for a single address.
+# Events arriving from paginated queries are consumed as they come, so the time spent waiting
+# for pages is counted here as well as in 'pages.wait'.
+@timed('process')
+def summarize_liquidity(data):
+    if numeric_engine == 'numpy':
+        return summarize_liquidity_vectorized(data)
+
+    # Net LP token amounts per pair
     address_summary = {}
 
     # Process mints
-    for mint in mints:
-        pair_id = mint['pair']['id']
-        liquidity = float(mint['liquidity'])
-
-        if pair_id not in address_summary:
-            address_summary[pair_id] = {'liquidity_minted': 0, 'liquidity_burned': 0}
+    for mint in data['mints']:
+        position = address_summary.get(mint.pair_id)
+        if position is None:
+            position = address_summary[mint.pair_id] = Position(mint.pair_id)
 
-        address_summary[pair_id]['liquidity_minted'] += liquidity
+        position.liquidity_minted += parse_liquidity(mint.liquidity)
 
     # Process burns
-    for burn in burns:
-        pair_id = burn['pair']['id']
-        liquidity = float(burn['liquidity'])
+    for burn in data['burns']:
+        position = address_summary.get(burn.pair_id)
+        if position is None:
+            position = address_summary[burn.pair_id] = Position(burn.pair_id)
+
+        position.liquidity_burned += parse_liquidity(burn.liquidity)
+
+    return address_summary
+
 
-        if pair_id not in address_summary:
-            address_summary[pair_id] = {'liquidity_minted': 0, 'liquidity_burned': 0}
+# Pair ids in which the address still holds a positive LP balance
+def open_pair_ids(address_summary):
+    return {pair_id for pair_id, position in address_summary.items() if position.net_liquidity > 0}
 
-        address_summary[pair_id]['liquidity_burned'] += liquidity
+
+# Amounts of token0 and token1 a net LP balance is worth in a pair, or None without a positive balance and supply
+def pair_share(net_liquidity, pair):
+    total_supply = parse_liquidity(pair.total_supply)
+    if net_liquidity <= 0 or total_supply <= 0:
+        return None
+
+    reserve0 = parse_reserve(pair.reserve0, pair.token0_decimals)
+    reserve1 = parse_reserve(pair.reserve1, pair.token1_decimals)
+    if arithmetic == 'exact':
+        # Integer share of each reserve, rounded down like the pair contract does on burn
+        return net_liquidity * reserve0 // total_supply, net_liquidity * reserve1 // total_supply
+
+    # Proportion of the pool owned by the user
+    proportion = net_liquidity / total_supply
+
+    # Calculate the user's share of token0 and token1
+    return proportion * reserve0, proportion * reserve1
+
+
+# Add the address's share of each pair's reserves to the address totals
+def apply_pairs(address_summary, pairs, address_totals):
+    if numeric_engine == 'numpy':
+        return apply_pairs_vectorized(address_summary, pair_columns(pairs), address_totals)
 
     # Calculate the current amount of tokens based on the LP balance and pair reserves
     for pair in pairs:
-        pair_id = pair['id']
-        total_supply = float(pair['totalSupply'])
-        reserve0 = float(pair['reserve0'])
-        reserve1 = float(pair['reserve1'])
+        position = address_summary.get(pair.id)
+
+        if position is not None:
+            share = pair_share(position.net_liquidity, pair)
+
+            if share is not None:
+                user_token0, user_token1 = share
+
+                # Add to address totals, keyed by token address since symbols are not unique
+                if pair.token0_id not in address_totals:
+                    address_totals[pair.token0_id] = 0
+                if pair.token1_id not in address_totals:
+                    address_totals[pair.token1_id] = 0
+
+                address_totals[pair.token0_id] += user_token0
+                address_totals[pair.token1_id] += user_token1
+
+
+# Vectorized summarize_liquidity: events are folded one page-sized chunk at a time, with
+# minted and burned liquidity grouped by pair index using bincount
+def summarize_liquidity_vectorized(data):
+    pair_index = {}
+    totals = {'mints': numpy.zeros(0), 'burns': numpy.zeros(0)}
+
+    for entity in ('mints', 'burns'):
+        rows = iter(data[entity])
+        while True:
+            chunk = list(itertools.islice(rows, page_size))
+            if not chunk:
+                break
+
+            indices = numpy.fromiter((pair_index.setdefault(event.pair_id, len(pair_index)) for event in chunk),
+                                     dtype=numpy.int64, count=len(chunk))
+            liquidity = numpy.array([event.liquidity for event in chunk], dtype=numpy.float64)
+            sums = numpy.bincount(indices, weights=liquidity, minlength=len(pair_index))
+            sums[:len(totals[entity])] += totals[entity]
+            totals[entity] = sums
+
+    minted = numpy.zeros(len(pair_index))
+    burned = numpy.zeros(len(pair_index))
+    minted[:len(totals['mints'])] = totals['mints']
+    burned[:len(totals['burns'])] = totals['burns']
+
+    return {pair_id: Position(pair_id, float(minted[index]), float(burned[index]))
+            for pair_id, index in pair_index.items()}
+
+
+# Column arrays of a chain's pairs, built once and shared by every address on the chain
+def pair_columns(pairs):
+    return {
+        'index': {pair.id: index for index, pair in enumerate(pairs)},
+        'total_supply': numpy.array([pair.total_supply for pair in pairs], dtype=numpy.float64),
+        'reserve0': numpy.array([pair.reserve0 for pair in pairs], dtype=numpy.float64),
+        'reserve1': numpy.array([pair.reserve1 for pair in pairs], dtype=numpy.float64),
+        'tokens': numpy.array([[pair.token0_id, pair.token1_id] for pair in pairs], dtype=object).reshape(-1, 2),
+    }
+
+
+# Vectorized apply_pairs: shares and token amounts for all of an address's pairs at once
+def apply_pairs_vectorized(address_summary, columns, address_totals):
+    held = sorted((columns['index'][pair_id], position.net_liquidity)
+                  for pair_id, position in address_summary.items() if pair_id in columns['index'])
+    if not held:
+        return
+
+    rows = numpy.array([row for row, net_liquidity in held], dtype=numpy.int64)
+    net_liquidity = numpy.array([net_liquidity for row, net_liquidity in held], dtype=numpy.float64)
+    total_supply = columns['total_supply'][rows]
+
+    # Proportion of each pool owned by the user, for pairs with a positive balance and supply
+    owned = (net_liquidity > 0) & (total_supply > 0)
+    rows, proportion = rows[owned], net_liquidity[owned] / total_supply[owned]
+
+    # token0 and token1 amounts interleaved, in the same order the scalar loop adds them
+    amounts = numpy.column_stack((proportion * columns['reserve0'][rows],
+                                  proportion * columns['reserve1'][rows])).ravel()
+    tokens = columns['tokens'][rows].ravel()
+
+    # Group amounts by token
+    token_order, token_index = numpy.unique(tokens, return_index=True, return_inverse=True)[1:]
+    sums = numpy.bincount(token_index, weights=amounts)
+    for position in numpy.sort(token_order):
+        token = tokens[position]
+        address_totals[token] = address_totals.get(token, 0) + float(sums[token_index[position]])
+
+
+# Process data for a single address and chain
+def process_data(data, address, address_totals):
+    apply_pairs(summarize_liquidity(data), data['pairs'], address_totals)
+
+
+# Export of per-pair positions and raw events for analytics. export_format is 'csv', 'ndjson',
+# 'parquet' or 'arrow' (the last two need pyarrow); export_directory receives positions.<ext> and
+# events.<ext>. Rows are written as results arrive, Arrow formats in batches of export_batch_size.
+# Snapshot runs export positions only.
+export_format = None
+export_directory = "export"
+export_batch_size = 10000
+export_writers = {}  # table -> writer, while an export is open
 
-        if pair_id in address_summary:
-            net_liquidity = address_summary[pair_id]['liquidity_minted'] - address_summary[pair_id]['liquidity_burned']
+# Columns of the exported tables. 'amount' columns are floats, or decimal strings with exact arithmetic.
+position_columns = [('chain', 'str'), ('subgraph_url', 'str'), ('name', 'str'), ('address', 'str'), ('block', 'int'),
+                    ('pair_id', 'str'), ('token0', 'str'), ('token1', 'str'), ('token0_symbol', 'str'),
+                    ('token1_symbol', 'str'), ('liquidity_minted', 'amount'), ('liquidity_burned', 'amount'),
+                    ('net_liquidity', 'amount'), ('total_supply', 'str'), ('reserve0', 'str'), ('reserve1', 'str'),
+                    ('token0_amount', 'amount'), ('token1_amount', 'amount')]
+event_columns = [('subgraph_url', 'str'), ('address', 'str'), ('entity', 'str'), ('id', 'str'), ('pair_id', 'str'),
+                 ('token0_symbol', 'str'), ('token1_symbol', 'str'), ('liquidity', 'str'),
+                 ('block_number', 'int'), ('timestamp', 'int')]
 
-            if net_liquidity > 0 and total_supply > 0:
-                # Proportion of the pool owned by the user
-                proportion = net_liquidity / total_supply
 
-                # Calculate the user's share of token0 and token1
-                user_token0 = proportion * reserve0
-                user_token1 = proportion * reserve1
+# Streams rows to a CSV file, one header line first
+class CsvExport:
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, kind in columns])
+        self.lock = threading.Lock()
 
-                token0_symbol = pair['token0']['symbol']
-                token1_symbol = pair['token1']['symbol']
+    def write(self, rows):
+        with self.lock:
+            self.writer.writerows(rows)
+            self.file.flush()
 
-                # Add to address totals
-                if token0_symbol not in address_totals:
-                    address_totals[token0_symbol] = 0
-                if token1_symbol not in address_totals:
-                    address_totals[token1_symbol] = 0
+    def close(self):
+        self.file.close()
 
-                address_totals[token0_symbol] += user_token0
-                address_totals[token1_symbol] += user_token1
+
+# Streams rows to a newline-delimited JSON file, one object per row
+class NdjsonExport:
+    def __init__(self, path, columns):
+        self.file = open(path, 'w')
+        self.names = [name for name, kind in columns]
+        self.lock = threading.Lock()
+
+    def write(self, rows):
+        lines = "".join(json.dumps(dict(zip(self.names, row))) + "\n" for row in rows)
+        with self.lock:
+            self.file.write(lines)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Writes rows to a Parquet file or an Arrow IPC file, one record batch per export_batch_size rows
+class ArrowExport:
+    def __init__(self, path, columns, parquet):
+        types = {'str': pyarrow.string(), 'int': pyarrow.int64(),
+                 'amount': pyarrow.string() if arithmetic == 'exact' else pyarrow.float64()}
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+        self.writer = (pyarrow.parquet.ParquetWriter(path, self.schema) if parquet
+                       else pyarrow.ipc.new_file(path, self.schema))
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def write(self, rows):
+        with self.lock:
+            self.pending.extend(rows)
+            if len(self.pending) >= export_batch_size:
+                self.flush()
+
+    def flush(self):
+        if self.pending:
+            columns = zip(*self.pending)
+            self.writer.write_batch(pyarrow.record_batch(
+                [pyarrow.array(values, field.type) for values, field in zip(columns, self.schema)], schema=self.schema))
+            self.pending = []
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.writer.close()
+
+
+# Open the export files for the selected format
+def open_exports():
+    os.makedirs(export_directory, exist_ok=True)
+    for table, columns in (('positions', position_columns), ('events', event_columns)):
+        path = os.path.join(export_directory, f"{table}.{export_format}")
+        if export_format == 'csv':
+            export_writers[table] = CsvExport(path, columns)
+        elif export_format == 'ndjson':
+            export_writers[table] = NdjsonExport(path, columns)
+        else:
+            export_writers[table] = ArrowExport(path, columns, export_format == 'parquet')
+
+
+# Finish and close the export files
+def close_exports():
+    while export_writers:
+        export_writers.popitem()[1].close()
+
+
+# Export form of an amount: a float, or a decimal string with exact arithmetic
+def export_amount(amount, decimals=amount_decimals):
+    return format_units(amount, decimals) if arithmetic == 'exact' else float(amount)
+
+
+# Export mints and burns of an address
+def export_events(subgraph_url, address, entity, events):
+    export_writers['events'].write([(subgraph_url, address.lower(), entity, event.id, event.pair_id, event.token0_symbol,
+                                     event.token1_symbol, event.liquidity, event.block_number, event.timestamp)
+                                    for event in events])
+
+
+# Pass an address's events through unchanged, exporting them a page at a time as they stream by
+def exported_events(subgraph_url, address, events):
+    if 'events' not in export_writers:
+        return events
+
+    def stream(entity):
+        batch = []
+        for event in events[entity]:
+            batch.append(event)
+            if len(batch) == page_size:
+                export_events(subgraph_url, address, entity, batch)
+                batch = []
+            yield event
+        export_events(subgraph_url, address, entity, batch)
+
+    return {entity: stream(entity) for entity in address_fields}
+
+
+# Export every cached event of an address, up to the block the cache has reached
+def export_cached_events(subgraph_url, address):
+    if 'events' not in export_writers:
+        return
+
+    events = load_cached_events(subgraph_url, address, load_watermark(subgraph_url, address)[0])
+    for entity in address_fields:
+        export_events(subgraph_url, address, entity, events[entity])
+
+
+# Export the positions of a chain's addresses, one row per held pair
+def export_positions(subgraph_url, subgraph_name, address_summaries, pairs, block=None):
+    if 'positions' not in export_writers:
+        return
+
+    rows = []
+    for address_name, address, address_summary in address_summaries:
+        for pair in pairs:
+            position = address_summary.get(pair.id)
+            share = position is not None and pair_share(position.net_liquidity, pair)
+            if share:
+                rows.append((subgraph_name, subgraph_url, address_name, address, block, pair.id,
+                             pair.token0_id, pair.token1_id, pair.token0_symbol, pair.token1_symbol,
+                             export_amount(position.liquidity_minted, lp_token_decimals),
+                             export_amount(position.liquidity_burned, lp_token_decimals),
+                             export_amount(position.net_liquidity, lp_token_decimals),
+                             pair.total_supply, pair.reserve0, pair.reserve1,
+                             export_amount(share[0]), export_amount(share[1])))
+    export_writers['positions'].write(rows)
+
+
+# Summarize a single address on a single chain, or return None if the query failed.
+# With the cache enabled the summary is the address's incrementally updated ledger.
+# With a block, the summary covers only events up to that block.
+def fetch_address_summary(subgraph_url, address, block=None):
+    try:
+        if block is not None:
+            return snapshot_summary(subgraph_url, address, block)
+        if cache_file is None:
+            return summarize_liquidity(exported_events(subgraph_url, address, query_chain(subgraph_url, address)))
+
+        address_summary = update_address_positions(subgraph_url, address)
+        export_cached_events(subgraph_url, address)
+        return address_summary
+    except QueryError as error:
+        print(error, file=sys.stderr)
+        return None
 
 
-# Main function
-def run_query():
+# Summarize a group of addresses on one chain, batching them into aliased queries if enabled.
+# Chains using the 'positions' strategy read the group's balances instead, bypassing the event cache.
+# Returns one summary (or None if its query failed) per address.
+def fetch_address_summaries(subgraph_url, addresses, block=None):
+    if chain_strategies.get(subgraph_url) == 'positions':
+        try:
+            return query_positions(subgraph_url, addresses, block)
+        except QueryError as error:
+            print(error, file=sys.stderr)
+            return [None] * len(addresses)
+
+    if not batch_addresses:
+        return [fetch_address_summary(subgraph_url, address, block) for address in addresses]
+
+    try:
+        if block is not None:
+            return [summarize_liquidity(events) for events in query_chain_batch(subgraph_url, addresses, None, block)]
+        if cache_file is None:
+            return [summarize_liquidity(exported_events(subgraph_url, address, events))
+                    for address, events in zip(addresses, query_chain_batch(subgraph_url, addresses))]
+
+        address_summaries = update_batch_positions(subgraph_url, addresses)
+        for address in addresses:
+            export_cached_events(subgraph_url, address)
+        return address_summaries
+    except QueryError as error:
+        print(error, file=sys.stderr)
+        return [None] * len(addresses)
+
+
+# Output format of run_query: 'text' prints totals as chains complete, 'json' prints one document at the end
+output_format = 'text'
+
+
+# Compute the totals of every address on a chain, display them and add them to the grand totals.
+# Each address's totals are also appended to results. Text goes to output, stdout by default.
+@timed('aggregate')
+def report_chain(subgraph_name, address_summaries, pairs, grand_totals, results, block=None, prices=None, output=None):
+    prices = prices or {}
+    symbols = {}
+    for pair in pairs:
+        symbols[pair.token0_id] = pair.token0_symbol
+        symbols[pair.token1_id] = pair.token1_symbol
+
+    if output_format == 'text':
+        at_block = f" at block {block}" if block is not None else ""
+        print(f"\n--- Processing chain: {subgraph_name}{at_block} ---", file=output)
+
+    if numeric_engine == 'numpy':
+        columns = pair_columns(pairs)
+
+    for address_name, address, address_summary in address_summaries:
+        address_totals = {}  # Totals for each address
+
+        # Process the data for this address
+        if numeric_engine == 'numpy':
+            apply_pairs_vectorized(address_summary, columns, address_totals)
+        else:
+            apply_pairs(address_summary, pairs, address_totals)
+        values = {token: float(format_amount(total)) * prices[token]
+                  for token, total in address_totals.items() if token in prices}
+        result = {'chain': subgraph_name, 'name': address_name, 'address': address,
+                  'totals': {token: format_amount(total) for token, total in address_totals.items()},
+                  'symbols': {token: symbols[token] for token in address_totals}}
+        if prices:
+            result['values'] = values
+        if block is not None:
+            result['block'] = block
+        results.append(result)
+
+        # Display totals for this address
+        if output_format == 'text':
+            labels = token_labels(result['symbols'])
+            print(f"\n  Address: {address_name} ({address})", file=output)
+            print(f"  Totals for {address_name}:", file=output)
+            for token, total in address_totals.items():
+                print(f"    {labels[token]}: {format_amount(total)}{format_value(values.get(token))}", file=output)
+            if values:
+                print(f"  Value: {format_value(sum(values.values())).strip(' ()')}", file=output)
+
+        # Add to grand totals, keyed by chain and token address
+        for token, total in address_totals.items():
+            if (subgraph_name, token) not in grand_totals:
+                grand_totals[(subgraph_name, token)] = 0
+            grand_totals[(subgraph_name, token)] += total
+
+
+# Display names of tokens: their symbols, followed by the token address where a symbol is shared
+def token_labels(symbols):
+    counts = Counter(symbols.values())
+    return {token: symbol if counts[symbol] == 1 else f"{symbol} ({token})" for token, symbol in symbols.items()}
+
+
+# Display suffix of a USD value, empty without a price
+def format_value(value):
+    return f" (${value:,.2f})" if value is not None else ""
+
+
+# Grand totals as rows with their chain, token address, symbol and, for priced tokens, USD value
+def grand_total_rows(grand_totals, results):
+    symbols = {}
+    values = {}
+    for result in results:
+        for token, symbol in result['symbols'].items():
+            symbols[(result['chain'], token)] = symbol
+        for token, value in result.get('values', {}).items():
+            values[(result['chain'], token)] = values.get((result['chain'], token), 0) + value
+
+    rows = []
+    for (chain, token), total in grand_totals.items():
+        row = {'chain': chain, 'token': token, 'symbol': symbols.get((chain, token)), 'amount': format_amount(total)}
+        if (chain, token) in values:
+            row['value'] = values[(chain, token)]
+        rows.append(row)
+    return rows
+
+
+# Display grand total rows, one line per chain and token, and their total value when priced
+def print_grand_totals(rows):
+    for chain in dict.fromkeys(row['chain'] for row in rows):
+        chain_rows = [row for row in rows if row['chain'] == chain]
+        labels = token_labels({row['token']: row['symbol'] for row in chain_rows})
+        for row in chain_rows:
+            print(f"{labels[row['token']]} on {chain}: {row['amount']}{format_value(row.get('value'))}")
+
+    values = [row['value'] for row in rows if 'value' in row]
+    if values:
+        print(f"Total value: {format_value(sum(values)).strip(' ()')}")
+
+
+# Query every (chain, address) selection concurrently and aggregate chains as they complete.
+# Phase one summarizes each address; once all addresses of a chain are in, phase two fetches
+# the chain's pairs and its totals are reported. blocks optionally maps chain names to a past
+# block to report positions at; chains mapped to None are skipped. Chain reports are written to output.
+def run_selections(selections, grand_totals, results, blocks=None, output=None):
+    chains = {}
+    pending = {}
+
+    with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+        def fetch_pairs(subgraph_name):
+            chain = chains[subgraph_name]
+            future = executor.submit(fetch_market, subgraph_name, chain['url'], chain['pair_ids'], chain['block'])
+            pending[future] = ('pairs', subgraph_name, None)
+
+        for subgraph_name, subgraph_url, selected_addresses in selections:
+            block = blocks[subgraph_name] if blocks is not None else None
+            if blocks is not None and block is None:
+                continue
+
+            chains[subgraph_name] = {'url': subgraph_url, 'addresses': selected_addresses, 'block': block,
+                                     'remaining': len(selected_addresses), 'summaries': {}, 'pair_ids': set()}
+
+            # Each task covers one address, or a batch of addresses sharing aliased queries
+            group_size = max(1, batch_max_aliases // len(address_fields)) if batch_addresses else 1
+            for start in range(0, len(selected_addresses), group_size):
+                indices = range(start, min(start + group_size, len(selected_addresses)))
+                addresses = [selected_addresses[index][1] for index in indices]
+                future = executor.submit(fetch_address_summaries, subgraph_url, addresses, block)
+                pending[future] = ('addresses', subgraph_name, indices)
+            if not selected_addresses:
+                fetch_pairs(subgraph_name)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, subgraph_name, indices = pending.pop(future)
+                chain = chains[subgraph_name]
+
+                if kind == 'addresses':
+                    for index, address_summary in zip(indices, future.result()):
+                        if address_summary is None:
+                            count('failed_queries', query='addresses')
+                        else:
+                            chain['summaries'][index] = address_summary
+                            chain['pair_ids'] |= open_pair_ids(address_summary)
+
+                    chain['remaining'] -= len(indices)
+                    if chain['remaining'] == 0:
+                        fetch_pairs(subgraph_name)
+                else:
+                    pairs, prices = future.result()
+                    if pairs is None:
+                        count('failed_queries', query='pairs')
+                        continue
+
+                    address_summaries = [chain['addresses'][index] + (chain['summaries'][index],)
+                                         for index in sorted(chain['summaries'])]
+                    report_chain(subgraph_name, address_summaries, pairs, grand_totals, results, chain['block'], prices, output)
+                    export_positions(chain['url'], subgraph_name, address_summaries, pairs, chain['block'])
+
+
+# Time summarize_liquidity and apply_pairs on synthetic events with float and with exact arithmetic,
+# and report how far the float totals drift from the exact ones. Both run on the python engine, the
+# only one with exact arithmetic, whatever --engine selects.
+def benchmark_arithmetic(event_count, pair_count=100):
+    global arithmetic, numeric_engine
+    generator = random.Random(0)
+
+    def amount(digits, decimals):
+        return f"{generator.randrange(10 ** digits)}.{generator.randrange(10 ** decimals):0{decimals}d}"
+
+    pairs = [Pair(f"pair{index}", f"token{index % 10}", f"usd{index % 3}", f"TOKEN{index % 10}", f"USD{index % 3}",
+                  18, 6, amount(9, 18), amount(9, 6), amount(12, 18))
+             for index in range(pair_count)]
+    events = [Mint(str(index), f"pair{generator.randrange(pair_count)}", '', '', amount(6, 18), 0, 0)
+              for index in range(event_count)]
+    data = {'mints': events, 'burns': [Burn(*astuple(event)) for event in events[::4]], 'pairs': pairs}
+
+    selected = arithmetic, numeric_engine
+    numeric_engine = 'python'
+    totals = {}
+    try:
+        for mode in ('float', 'exact'):
+            arithmetic = mode
+            totals[mode] = {}
+            start = time.perf_counter()
+            process_data(data, None, totals[mode])
+            elapsed = time.perf_counter() - start
+            print(f"{mode:>5}: {elapsed:.3f} s, {event_count * 1.25 / elapsed:,.0f} events/s")
+    finally:
+        arithmetic, numeric_engine = selected
+
+    drift = max(abs(Decimal(totals['float'][token]) - Decimal(format_units(exact))) / Decimal(format_units(exact))
+                for token, exact in totals['exact'].items() if exact)
+    print(f"largest relative error of float totals: {drift:.3e}")
+
+
+# Turn chain and address names given on the command line into selections.
+# 'all' selects every stored chain or address, 'tag:NAME' every address with that tag;
+# addresses may also be given directly as 0x... values. Groups add their members, and each chain
+# gets the selected addresses that are members of it.
+def resolve_selections(data, chain_names, address_names, group_names=None):
+    if chain_names == ['all']:
+        chain_names = list(data['subgraphs'])
+    if (not address_names and not group_names) or address_names == ['all']:
+        address_names = list(data['addresses'])
+
+    selected_addresses = []
+    for name in group_names or []:
+        if name not in data['groups']:
+            sys.exit(f"Unknown group: {name}")
+        selected_addresses += [(address_name, data['addresses'][address_name]) for address_name in data['groups'][name]]
+
+    for name in address_names or []:
+        if name in data['addresses']:
+            selected_addresses.append((name, data['addresses'][name]))
+        elif name.startswith('tag:'):
+            tagged = tagged_addresses(name[len('tag:'):])
+            if not tagged:
+                sys.exit(f"No addresses tagged {name[len('tag:'):]}")
+            selected_addresses.extend(tagged)
+        elif name.startswith('0x'):
+            selected_addresses.append((name, name))
+        else:
+            sys.exit(f"Unknown address: {name}")
+    selected_addresses = list(dict.fromkeys(selected_addresses))
+
+    selections = []
+    for name in chain_names:
+        if name not in data['subgraphs']:
+            sys.exit(f"Unknown chain: {name}")
+        selections.append((name, canonical_url(data['subgraphs'][name]),
+                           chain_addresses(data, name, selected_addresses)))
+
+    return selections
+
+
+# Maximum number of historical snapshots computed at once
+max_concurrent_snapshots = 4
+
+
+# Parse a snapshot time given as unix seconds or an ISO 8601 date (UTC unless it names a zone)
+def parse_timestamp(value):
+    if value.isdigit():
+        return int(value)
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid timestamp: {value!r}")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+# Map every selected chain to the block of a snapshot: the block itself, or the chain's
+# last block at or before the snapshot time (None if the chain has no history by then)
+def snapshot_blocks(selections, kind, value):
+    if kind == 'block':
+        return {subgraph_name: value for subgraph_name, _, _ in selections}
+
+    with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+        futures = {subgraph_name: executor.submit(block_at_timestamp, subgraph_url, value)
+                   for subgraph_name, subgraph_url, _ in selections}
+    return {subgraph_name: future.result() for subgraph_name, future in futures.items()}
+
+
+# Compute one historical snapshot of the selections, returning its per-address and grand totals
+# and its text chain reports, buffered so concurrent snapshots don't interleave their output
+def run_snapshot(selections, kind, value):
+    grand_totals = {}
+    results = []
+    output = io.StringIO()
+    try:
+        blocks = snapshot_blocks(selections, kind, value)
+    except QueryError as error:
+        print(error, file=sys.stderr)
+        count('failed_queries', query='blocks')
+        return results, grand_totals, output.getvalue()
+
+    run_selections(selections, grand_totals, results, blocks, output)
+    return results, grand_totals, output.getvalue()
+
+
+# Report positions at several past blocks or times, computing up to max_concurrent_snapshots at once.
+# Each snapshot is a (kind, value) pair where kind is 'block' or 'timestamp'.
+def run_snapshots(selections, snapshots):
+    with ThreadPoolExecutor(max_workers=max_concurrent_snapshots) as executor:
+        futures = [executor.submit(run_snapshot, selections, kind, value) for kind, value in snapshots]
+
+        reports = []
+        texts = []
+        for (kind, value), future in zip(snapshots, futures):
+            results, grand_totals, text = future.result()
+            reports.append({kind: value, 'addresses': results, 'grand_totals': grand_total_rows(grand_totals, results)})
+            texts.append(text)
+
+    if output_format == 'json':
+        print(json.dumps({'snapshots': reports}, indent=2))
+        return
+
+    for report, text in zip(reports, texts):
+        kind, value = next(iter(report.items()))
+        print(text, end='')
+        print(f"\n--- Grand Totals at {kind} {value} ---")
+        print_grand_totals(report['grand_totals'])
+
+
+# Prometheus label set of a counter
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+# Metrics in the Prometheus text exposition format
+def prometheus_metrics():
+    with metrics_lock:
+        timings = sorted(phase_timings.items())
+        counted = sorted(counters.items())
+
+    lines = ["# HELP graphquery_phase_seconds Time spent per phase, summed across threads",
+             "# TYPE graphquery_phase_seconds summary"]
+    for phase, (spans, total, longest) in timings:
+        lines.append(f'graphquery_phase_seconds_count{{phase="{phase}"}} {spans}')
+        lines.append(f'graphquery_phase_seconds_sum{{phase="{phase}"}} {total}')
+    lines.append("# TYPE graphquery_phase_seconds_max gauge")
+    lines += [f'graphquery_phase_seconds_max{{phase="{phase}"}} {longest}' for phase, (_, _, longest) in timings]
+
+    for name in dict.fromkeys(name for (name, _), _ in counted):
+        lines.append(f"# TYPE graphquery_{name}_total counter")
+        lines += [f"graphquery_{name}_total{prometheus_labels(labels)} {value}"
+                  for (counter, labels), value in counted if counter == name]
+    return "\n".join(lines) + "\n"
+
+
+# Metrics as an OpenTelemetry (OTLP/JSON) metrics export: phases as summaries, counters as monotonic sums
+def otlp_metrics():
+    with metrics_lock:
+        timings = sorted(phase_timings.items())
+        counted = sorted(counters.items())
+
+    window = {'startTimeUnixNano': str(int(metrics_started * 1e9)), 'timeUnixNano': str(time.time_ns())}
+
+    def attributes(labels):
+        return [{'key': name, 'value': {'stringValue': str(value)}} for name, value in labels]
+
+    metrics = [{'name': 'graphquery.phase.duration', 'unit': 's', 'summary': {'dataPoints': [
+        dict(window, attributes=attributes([('phase', phase)]), count=str(spans), sum=total,
+             quantileValues=[{'quantile': 1.0, 'value': longest}])
+        for phase, (spans, total, longest) in timings]}}]
+
+    for name in dict.fromkeys(name for (name, _), _ in counted):
+        metrics.append({'name': f'graphquery.{name}', 'sum': {
+            'aggregationTemporality': 2, 'isMonotonic': True,
+            'dataPoints': [dict(window, attributes=attributes(labels), asInt=str(value))
+                           for (counter, labels), value in counted if counter == name]}})
+
+    return {'resourceMetrics': [{
+        'resource': {'attributes': attributes([('service.name', 'graphquery')])},
+        'scopeMetrics': [{'scope': {'name': 'graphquery'}, 'metrics': metrics}]}]}
+
+
+# Metrics as a summary table. Phases overlap across threads, so their totals can exceed the run time.
+def metrics_table():
+    with metrics_lock:
+        timings = sorted(phase_timings.items())
+        counted = sorted(counters.items())
+
+    lines = [f"\n--- Metrics ({time.time() - metrics_started:.2f}s run) ---",
+             f"  {'phase':<16}{'spans':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}"]
+    for phase, (spans, total, longest) in timings:
+        lines.append(f"  {phase:<16}{spans:>8}{total:>10.3f}{total / spans * 1000:>10.1f}{longest * 1000:>10.1f}")
+
+    lines.append("")
+    for (name, labels), value in counted:
+        label_text = " ".join(f"{label}={label_value}" for label, label_value in labels)
+        lines.append(f"  {name:<20}{value:>12,}  {label_text}")
+    return "\n".join(lines)
+
+
+# Report the metrics collected so far in the selected format, if any
+def report_metrics():
+    if metrics_format is None:
+        return
+
+    if metrics_format == 'table':
+        text = metrics_table()
+    elif metrics_format == 'prometheus':
+        text = prometheus_metrics()
+    else:
+        text = json.dumps(otlp_metrics(), indent=2)
+
+    if metrics_file:
+        with open(metrics_file, 'w') as f:
+            f.write(text)
+    else:
+        # Keep JSON results on stdout parseable
+        print(text, file=sys.stderr if output_format == 'json' else sys.stdout)
+
+
+# Choose the chains and addresses to report interactively
+@timed('prompt')
+def prompt_selections():
     data = load_data()
 
     # Select multiple subgraphs (chains)
     selected_subgraphs = get_subgraphs(data)
 
-    grand_totals = {}  # Grand totals across all chains and addresses
+    # Select addresses once before any query is sent; each chain gets the selected addresses that are its members
+    selected_addresses = get_addresses(data)
+    return [(subgraph_name, subgraph_url, chain_addresses(data, subgraph_name, selected_addresses))
+            for subgraph_name, subgraph_url in selected_subgraphs]
+
+
+# Main function. Without selections the chains and addresses are chosen interactively.
+# With snapshots, positions are reported at each past block or time instead of now.
+def run_query(selections=None, snapshots=None):
+    if selections is None:
+        selections = prompt_selections()
+
+    if export_format is not None:
+        open_exports()
+    try:
+        if snapshots:
+            run_snapshots(selections, snapshots)
+            report_metrics()
+            return
+
+        grand_totals = {}  # Grand totals across all chains and addresses
+        results = []  # Totals of every (chain, address)
+
+        run_selections(selections, grand_totals, results)
+    finally:
+        close_exports()
 
-    for subgraph_name, subgraph_url in selected_subgraphs:
-        print(f"\n--- Processing chain: {subgraph_name} ---")
+    if output_format == 'json':
+        print(json.dumps({'addresses': results, 'grand_totals': grand_total_rows(grand_totals, results)}, indent=2))
+    else:
+        # Display grand totals across all chains and addresses
+        print("\n--- Grand Totals across all chains and addresses ---")
+        print_grand_totals(grand_total_rows(grand_totals, results))
+
+    report_metrics()
+
+
+# Service mode: address the HTTP endpoint listens on, seconds between head polls,
+# number of delta notifications kept, and longest wait of a /deltas request
+serve_host = '127.0.0.1'
+serve_port = 8080
+poll_interval = 15
+max_deltas = 10000
+max_delta_wait = 60
+
+# State shared between the poll loop and the HTTP handlers, guarded by service_changed:
+# the head each chain was last computed at, the latest result of every (chain, address),
+# and the numbered log of per-address changes
+service_changed = threading.Condition()
+service_heads = {}
+service_positions = {}
+service_deltas = []
+service_sequence = 0
+
+
+# Difference between two token totals, as a float or as an exact decimal string
+def amount_delta(total, previous):
+    if isinstance(total, str) or isinstance(previous, str):
+        return format_units(parse_units(str(total), amount_decimals) - parse_units(str(previous), amount_decimals))
+    return total - previous
+
+
+# Store a chain's fresh results and log a delta for every address whose totals changed.
+# Addresses whose queries failed keep their previous totals until the next refresh.
+def record_results(subgraph_name, head, results):
+    global service_sequence
+
+    changed = 0
+    with service_changed:
+        service_heads[subgraph_name] = head
+        for result in results:
+            key = (subgraph_name, result['address'])
+            previous = service_positions.get(key, {}).get('totals', {})
+            service_positions[key] = dict(result, block=head)
+
+            deltas = {token: amount_delta(result['totals'].get(token, 0), previous.get(token, 0))
+                      for token in result['totals'].keys() | previous.keys()}
+            deltas = {token: delta for token, delta in deltas.items() if delta not in (0, '0')}
+            if deltas:
+                service_sequence += 1
+                service_deltas.append(dict(result, block=head, sequence=service_sequence, deltas=deltas))
+                changed += 1
+
+        del service_deltas[:-max_deltas]
+        service_changed.notify_all()
+    return changed
+
+
+# Poll every chain's head and recompute the positions of the chains whose head advanced.
+# Sessions, connection pools and caches stay warm between rounds.
+def refresh_positions(selections):
+    with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+        heads = {subgraph_name: executor.submit(get_chain_head, subgraph_url)
+                 for subgraph_name, subgraph_url, _ in selections}
+
+    advanced = {}
+    for subgraph_name, subgraph_url, selected_addresses in selections:
+        try:
+            head = heads[subgraph_name].result()[0]
+        except QueryError as error:
+            print(error, file=sys.stderr)
+            continue
+        if head != service_heads.get(subgraph_name):
+            advanced[subgraph_name] = (head, (subgraph_name, subgraph_url, selected_addresses))
+
+    if not advanced:
+        return
 
-        # Select multiple addresses for each subgraph
-        selected_addresses = get_addresses(data, subgraph_name)
+    # Reserves may have changed in the new blocks even if the cached pairs are young
+    for _, (_, subgraph_url, _) in advanced.values():
+        pair_refetch_after[subgraph_url] = time.time()
 
-        for address_name, address in selected_addresses:
-            print(f"\n  Address: {address_name} ({address})")
-            address_totals = {}  # Totals for each address
+    results = []
+    run_selections([selection for _, selection in advanced.values()], {}, results)
 
-            # Query the chain for this address
-            query_result = query_chain(subgraph_url, address)
-            if query_result:
-                # Process the data for this address
-                process_data(query_result, address, address_totals)
+    for subgraph_name, (head, (_, _, selected_addresses)) in advanced.items():
+        chain_results = [result for result in results if result['chain'] == subgraph_name]
+        changed = record_results(subgraph_name, head, chain_results)
+        print(f"{subgraph_name} at block {head}: {changed} of {len(selected_addresses)} addresses changed")
 
-                # Display totals for this address
-                print(f"  Totals for {address_name}:")
-                for token, total in address_totals.items():
-                    print(f"    {token}: {total}")
+        # Retry the failed addresses on the next poll even if the head has not moved
+        if len(chain_results) < len(selected_addresses):
+            with service_changed:
+                service_heads.pop(subgraph_name, None)
 
-                # Add to grand totals
-                for token, total in address_totals.items():
-                    if token not in grand_totals:
-                        grand_totals[token] = 0
-                    grand_totals[token] += total
 
-    # Display grand totals across all chains and addresses
-    print("\n--- Grand Totals across all chains and addresses ---")
-    for token, total in grand_totals.items():
-        print(f"{token}: {total}")
+# HTTP/JSON interface of the service mode.
+# GET /positions returns the latest totals of every address.
+# GET /deltas?since=N waits up to wait seconds for changes numbered after N and returns them.
+# GET /metrics returns the instrumentation counters in the Prometheus text format.
+class ServiceHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parameters = parse_qs(url.query)
+
+        try:
+            if url.path == '/metrics':
+                self.send_content(prometheus_metrics().encode(), 'text/plain; version=0.0.4')
+                return
+            elif url.path == '/positions':
+                with service_changed:
+                    body = {'sequence': service_sequence, 'heads': dict(service_heads),
+                            'addresses': list(service_positions.values())}
+            elif url.path == '/deltas':
+                since = int(parameters.get('since', ['0'])[0])
+                timeout = min(float(parameters.get('wait', ['0'])[0]), max_delta_wait)
+                with service_changed:
+                    service_changed.wait_for(lambda: service_sequence > since, timeout)
+                    body = {'sequence': service_sequence,
+                            'deltas': [delta for delta in service_deltas if delta['sequence'] > since]}
+            else:
+                self.send_error(404)
+                return
+        except ValueError:
+            self.send_error(400, "since and wait must be numbers")
+            return
+
+        self.send_content(json.dumps(body).encode(), 'application/json')
+
+    def send_content(self, content, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    # Keep the console for refresh reports
+    def log_message(self, format, *args):
+        pass
+
+
+# Run as a long-lived service: keep positions current by polling chain heads and serve them over HTTP
+def run_service(selections=None):
+    if selections is None:
+        selections = prompt_selections()
+
+    server = ThreadingHTTPServer((serve_host, serve_port), ServiceHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving positions on http://{serve_host}:{server.server_address[1]}/positions")
+
+    try:
+        while True:
+            started = time.time()
+            refresh_positions(selections)
+            time.sleep(max(0, poll_interval - (time.time() - started)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+# Read command line options. Passing --chains runs without any prompts.
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Report liquidity positions across subgraphs.")
+    parser.add_argument('--chains', nargs='+', metavar='NAME',
+                        help="stored chain names to query, or 'all'; skips the interactive prompts")
+    parser.add_argument('--addresses', nargs='+', metavar='NAME',
+                        help="stored address names, tag:NAME for every address with a tag, or 0x addresses to "
+                             "query, or 'all' (default with --chains)")
+    parser.add_argument('--group', nargs='+', metavar='NAME',
+                        help="stored address groups to query; each chain gets the members stored for it")
+    parser.add_argument('--set-endpoints', nargs='+', metavar=('CHAIN', 'URL'),
+                        help="add a chain or replace a stored chain's GraphQL endpoints with these URLs, "
+                             "the first of which names the chain in caches, then exit")
+    parser.add_argument('--set-strategy', nargs=2, metavar=('CHAIN', 'STRATEGY'),
+                        help=f"store how a chain's positions are read: {' or '.join(position_strategies)} "
+                             f"(current LiquidityPosition balances, for Uniswap-V2-style subgraphs), then exit")
+    parser.add_argument('--import-addresses', metavar='CSV',
+                        help="add the addresses in a CSV file with name and address columns and optional tags, "
+                             "groups and chains columns (separated by ';') to the registry, then exit")
+    parser.add_argument('--format', choices=['text', 'json'], default=output_format,
+                        help=f"output format (default: {output_format})")
+    parser.add_argument('--concurrency', type=int, default=max_concurrent_requests, metavar='N',
+                        help=f"maximum HTTP requests in flight (default: {max_concurrent_requests})")
+    parser.add_argument('--batch', action='store_true',
+                        help="query many addresses per request using aliased documents")
+    parser.add_argument('--engine', choices=['python', 'numpy'], default=numeric_engine,
+                        help=f"position math engine (default: {numeric_engine})")
+    parser.add_argument('--arithmetic', choices=['float', 'exact'], default=arithmetic,
+                        help=f"float or exact fixed-point amounts (default: {arithmetic})")
+    parser.add_argument('--benchmark-arithmetic', type=int, metavar='EVENTS',
+                        help="compare float and exact arithmetic on this many synthetic events and exit")
+    parser.add_argument('--max-staleness', type=float, default=pair_max_staleness, metavar='SECONDS',
+                        help="reuse cached pair reserves and supply up to this many seconds old "
+                             f"(default: {pair_max_staleness:g}, 0 always refetches)")
+    parser.add_argument('--serve', nargs='?', type=int, const=serve_port, metavar='PORT',
+                        help=f"keep running, refresh positions as chain heads advance and serve them over "
+                             f"HTTP/JSON on this port (default: {serve_port})")
+    parser.add_argument('--poll-interval', type=float, default=poll_interval, metavar='SECONDS',
+                        help=f"seconds between chain head polls with --serve (default: {poll_interval:g})")
+    parser.add_argument('--prices', metavar='SOURCE',
+                        help="value totals in USD with prices from 'subgraph' (derivedETH x ethPrice) or a JSON file "
+                             "mapping '<chain>:<token address>' or '<token address>' to a price")
+    parser.add_argument('--price-ttl', type=float, default=price_ttl, metavar='SECONDS',
+                        help=f"reuse looked-up prices for this many seconds (default: {price_ttl:g})")
+    parser.add_argument('--metrics', choices=['table', 'prometheus', 'otlp'],
+                        help="report per-phase timings and counters at the end of the run")
+    parser.add_argument('--metrics-file', metavar='FILE',
+                        help="write the --metrics report to this file instead of the console")
+    parser.add_argument('--export', choices=['csv', 'ndjson', 'parquet', 'arrow'],
+                        help="also write per-pair positions and raw mints and burns to files in this format")
+    parser.add_argument('--export-dir', default=export_directory, metavar='DIR',
+                        help=f"directory receiving the export files (default: {export_directory})")
+    snapshot = parser.add_mutually_exclusive_group()
+    snapshot.add_argument('--blocks', nargs='+', type=int, metavar='N',
+                          help="report positions as of each of these blocks instead of now")
+    snapshot.add_argument('--timestamps', nargs='+', type=parse_timestamp, metavar='TIME',
+                          help="report positions as of each of these unix times or ISO dates (UTC)")
+    arguments = parser.parse_args()
+
+    if arguments.set_endpoints and len(arguments.set_endpoints) < 2:
+        parser.error("--set-endpoints takes a chain name followed by at least one URL")
+    if arguments.set_strategy and arguments.set_strategy[1] not in position_strategies:
+        parser.error(f"--set-strategy takes one of {', '.join(position_strategies)}")
+    if arguments.group and not arguments.chains:
+        parser.error("--group requires --chains")
+    if arguments.addresses and not arguments.chains:
+        parser.error("--addresses requires --chains")
+    if arguments.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if arguments.engine == 'numpy' and numpy is None:
+        parser.error("--engine numpy requires numpy to be installed")
+    if arguments.engine == 'numpy' and arguments.arithmetic == 'exact':
+        parser.error("--engine numpy only supports --arithmetic float")
+    if arguments.export in ('parquet', 'arrow') and pyarrow is None:
+        parser.error(f"--export {arguments.export} requires pyarrow to be installed")
+    if arguments.serve is not None and arguments.export:
+        parser.error("--export writes a single run's results and cannot be combined with --serve")
+    if arguments.serve is not None and (arguments.blocks or arguments.timestamps):
+        parser.error("--serve reports current positions and cannot be combined with --blocks or --timestamps")
+    return arguments
 
 
 # Run the program
-run_query()
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    pair_max_staleness = arguments.max_staleness
+    output_format = arguments.format
+    poll_interval = arguments.poll_interval
+    metrics_format = arguments.metrics
+    metrics_file = arguments.metrics_file
+    export_format = arguments.export
+    price_source = arguments.prices
+    price_ttl = arguments.price_ttl
+    export_directory = arguments.export_dir
+    max_concurrent_requests = arguments.concurrency
+    batch_addresses = arguments.batch
+    numeric_engine = arguments.engine
+    arithmetic = arguments.arithmetic
+
+    snapshots = ([('block', block) for block in arguments.blocks or []] +
+                 [('timestamp', timestamp) for timestamp in arguments.timestamps or []])
+
+    if arguments.set_endpoints:
+        set_endpoints(load_data(), arguments.set_endpoints[0], arguments.set_endpoints[1:])
+    elif arguments.set_strategy:
+        if not set_strategy(load_data(), *arguments.set_strategy):
+            sys.exit(1)
+    elif arguments.import_addresses:
+        if import_addresses(arguments.import_addresses) is None:
+            sys.exit(1)
+    elif arguments.benchmark_arithmetic:
+        benchmark_arithmetic(arguments.benchmark_arithmetic)
+    elif arguments.serve is not None:
+        # The service answers over HTTP; refreshes only print a one-line report
+        serve_port = arguments.serve
+        output_format = 'json'
+        run_service(resolve_selections(load_data(), arguments.chains, arguments.addresses, arguments.group)
+                    if arguments.chains else None)
+    elif arguments.chains:
+        run_query(resolve_selections(load_data(), arguments.chains, arguments.addresses, arguments.group), snapshots)
+    else:
+        run_query(None, snapshots)
+
+    # Let schedulers tell a run with missing chains or addresses from a complete one
+    if any(name == 'failed_queries' for name, _ in counters):
+        sys.exit(1)
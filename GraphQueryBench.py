@@ -0,0 +1,825 @@
+import json
+import os
+import re
+import sys
+import io
+import gzip
+import time
+import types
+import bisect
+import shlex
+import builtins
+import argparse
+import tempfile
+import resource
+import runpy
+import contextlib
+import itertools
+import functools
+import threading
+import multiprocessing
+import urllib.request
+import importlib.util
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Benchmark harness: serves synthetic mints, burns, liquidity positions and pairs from a local fake
+# graph-node and runs the GraphQuery scripts end to end against it, one fresh process per run.
+#
+#   python GraphQueryBench.py --chains 1 10 --addresses 1 100 --events 100 10000
+#   python GraphQueryBench.py --scripts GrapohQuery0.3.py GraphQuery0.4.py --latency 0.05
+#   python GraphQueryBench.py --faults '{"chain0": {"status": 503, "count": 20}}'
+#   python GraphQueryBench.py --check
+#
+# Every chain holds the same wallets; a chain's events are split evenly between them.
+
+# Shape of the synthetic chains: pairs per chain, indexed head block and time of block zero
+pair_count = 200
+head_block = 1000000
+genesis_timestamp = 1600000000
+block_time = 12
+
+# Rows returned when a collection query does not ask for a count, and the most it may ask for
+default_first = 100
+max_first = 1000
+
+# Address prefixes keeping the synthetic wallets, pairs and tokens apart
+wallet_prefix = 0xbeef
+pair_prefix = 0xfa17
+token_prefix = 0x70c0
+
+# Tokenizer of GraphQL documents: spreads, punctuation, strings, numbers and names
+token_pattern = re.compile(r'\s*(?:(\.\.\.)|([{}()\[\]:,!=$@])|("(?:[^"\\]|\\.)*")|(-?\d+(?:\.\d+)?)|([A-Za-z_]\w*))')
+
+
+# Split a GraphQL document into tokens, dropping comments
+def tokenize(document):
+    document = re.sub(r'#[^\n]*', '', document)
+    tokens = []
+    position = 0
+    while document[position:].strip():
+        match = token_pattern.match(document, position)
+        if not match:
+            raise ValueError(f"Syntax error at {document[position:position + 20]!r}")
+        position = match.end()
+        tokens.append(next(group for group in match.groups() if group is not None))
+    return tokens
+
+
+# Recursive-descent parser for the query subset the scripts send: one operation with variable
+# definitions, aliases, arguments and nested selections
+class DocumentParser:
+    def __init__(self, document):
+        self.tokens = tokenize(document)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.tokens[self.position]
+        if expected is not None and token != expected:
+            raise ValueError(f"Expected {expected}, found {token}")
+        self.position += 1
+        return token
+
+    # Skip the operation header (query Name($variable: Type!, ...)) and parse its selection set
+    def operation(self):
+        if self.peek() == 'query':
+            self.take()
+            if self.peek() not in ('(', '{'):
+                self.take()
+            if self.peek() == '(':
+                depth = 0
+                while True:
+                    token = self.take()
+                    depth += {'(': 1, ')': -1}.get(token, 0)
+                    if depth == 0:
+                        break
+        return self.selection()
+
+    # Parse a selection set into (alias, field, arguments, sub-selection) tuples
+    def selection(self):
+        self.take('{')
+        fields = []
+        while self.peek() != '}':
+            alias = field = self.take()
+            if self.peek() == ':':
+                self.take()
+                field = self.take()
+            arguments = {}
+            if self.peek() == '(':
+                self.take()
+                while self.peek() != ')':
+                    name = self.take()
+                    self.take(':')
+                    arguments[name] = self.value()
+                    if self.peek() == ',':
+                        self.take()
+                self.take(')')
+            sub_selection = self.selection() if self.peek() == '{' else None
+            fields.append((alias, field, arguments, sub_selection))
+            if self.peek() == ',':
+                self.take()
+        self.take('}')
+        return fields
+
+    # Parse an argument value; variables are kept as ('$', name) until execution
+    def value(self):
+        token = self.take()
+        if token == '$':
+            return ('$', self.take())
+        if token == '{':
+            value = {}
+            while self.peek() != '}':
+                name = self.take()
+                self.take(':')
+                value[name] = self.value()
+                if self.peek() == ',':
+                    self.take()
+            self.take('}')
+            return value
+        if token == '[':
+            value = []
+            while self.peek() != ']':
+                value.append(self.value())
+                if self.peek() == ',':
+                    self.take()
+            self.take(']')
+            return value
+        if token.startswith('"'):
+            return json.loads(token)
+        if token[0].isdigit() or token[0] == '-':
+            return float(token) if '.' in token else int(token)
+        return {'true': True, 'false': False, 'null': None}.get(token, token)
+
+
+# Substitute variables into parsed argument values
+def resolve_arguments(value, variables):
+    if isinstance(value, tuple):
+        return variables.get(value[1])
+    if isinstance(value, dict):
+        return {name: resolve_arguments(item, variables) for name, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_arguments(item, variables) for item in value]
+    return value
+
+
+# Keep only the requested fields of a row, recursively
+def project(row, selection):
+    if selection is None or row is None:
+        return row
+    if isinstance(row, list):
+        return [project(item, selection) for item in row]
+    return {alias: project(row.get(field), sub_selection) for alias, field, _, sub_selection in selection}
+
+
+# Format an integer amount of wei as a BigDecimal string
+def format_wei(amount):
+    return f"{amount // 10 ** 18}.{amount % 10 ** 18:018d}"
+
+
+# One synthetic subgraph. Rows are computed from their index on demand, so even millions of
+# events cost no memory and any page is found without scanning the ones before it.
+class SyntheticChain:
+    def __init__(self, address_count, events_per_address):
+        self.address_count = address_count
+        self.events_per_address = events_per_address
+        self.wallets = [wallet_address(index) for index in range(address_count)]
+        self.wallet_indices = {wallet: index for index, wallet in enumerate(self.wallets)}
+        self.tokens = [self.token(index) for index in range(pair_count + 1)]
+        self.pairs = [self.pair(index) for index in range(pair_count)]
+        self.pair_indices = {pair['id']: index for index, pair in enumerate(self.pairs)}
+
+    def token(self, index):
+        return {'id': f"0x{token_prefix:04x}{index:036x}", 'symbol': f"TK{index % 50}",
+                'name': f"Token {index}", 'decimals': '6' if index % 5 == 0 else '18',
+                'derivedETH': f"0.{index * 7919 % 10 ** 6:06d}"}
+
+    def pair(self, index):
+        return {'id': f"0x{pair_prefix:04x}{index:036x}", 'token0': self.tokens[index], 'token1': self.tokens[index + 1],
+                'reserve0': f"{(index + 1) * 1234567 % 10 ** 7 + 10 ** 6}.{index:06d}",
+                'reserve1': f"{(index + 7) * 7654321 % 10 ** 7 + 10 ** 6}.{index:06d}",
+                'totalSupply': f"{10 ** 6 + index}.5"}
+
+    # Block of a wallet's event; events are spread evenly over the chain's history
+    def event_block(self, event):
+        return 1 + event * (head_block - 1) // self.events_per_address
+
+    # Pair and liquidity (negative for burns) of a wallet's event.
+    # Every third event of a wallet burns half the liquidity minted by the event before it
+    def event_liquidity(self, wallet, event):
+        is_burn = event % 3 == 2
+        minted = event - 1 if is_burn else event
+        pair = (wallet * 31 + minted * 17) % pair_count
+        liquidity = 10 ** 17 + ((wallet + 1) * 2654435761 + (minted + 1) * 40503) % 10 ** 19
+        return pair, -(liquidity // 2) if is_burn else liquidity
+
+    def event_row(self, wallet, event):
+        pair, liquidity = self.event_liquidity(wallet, event)
+        block = self.event_block(event)
+        timestamp = str(genesis_timestamp + block * block_time)
+        return {'id': f"0x{wallet:08x}{event:010x}", 'to': self.wallets[wallet], 'sender': self.wallets[wallet],
+                'liquidity': format_wei(abs(liquidity)), 'timestamp': timestamp,
+                'pair': self.pairs[pair],
+                'transaction': {'id': f"0x{wallet:032x}{event:032x}", 'blockNumber': str(block), 'timestamp': timestamp}}
+
+    # mints or burns of one wallet, in id order, after a cursor and within a block range
+    def events(self, entity, arguments, block):
+        where = arguments.get('where') or {}
+        wallet = self.wallet_indices.get(str(where.get('to' if entity == 'mints' else 'sender', '')).lower())
+        if wallet is None:
+            return []
+
+        start = 0
+        if where.get('id_gt'):
+            start = int(where['id_gt'][10:], 16) + 1
+        after_block = int((where.get('transaction_') or {}).get('blockNumber_gt', 0))
+        start = max(start, bisect.bisect_right(range(self.events_per_address), after_block, key=self.event_block))
+
+        rows = []
+        first = min(arguments.get('first', default_first), max_first)
+        for event in range(start, self.events_per_address):
+            if len(rows) == first or self.event_block(event) > block:
+                break
+            if (event % 3 == 2) == (entity == 'burns'):
+                rows.append(self.event_row(wallet, event))
+        return rows
+
+    # LP balances of a wallet as of a block, by pair index, summed from its events
+    @functools.lru_cache(maxsize=1024)
+    def balances(self, wallet, block):
+        balances = {}
+        for event in range(bisect.bisect_right(range(self.events_per_address), block, key=self.event_block)):
+            pair, liquidity = self.event_liquidity(wallet, event)
+            balances[pair] = balances.get(pair, 0) + liquidity
+        return balances
+
+    # Open liquidity positions of the wallets in user_in (or of user), in id order after a cursor
+    def position_rows(self, arguments, block):
+        where = arguments.get('where') or {}
+        users = where['user_in'] if 'user_in' in where else [where.get('user', '')]
+        rows = []
+        for user in users:
+            wallet = self.wallet_indices.get(str(user).lower())
+            if wallet is None:
+                continue
+            for pair, balance in self.balances(wallet, block).items():
+                if balance > 0:
+                    rows.append({'id': f"{self.pairs[pair]['id']}-{self.wallets[wallet]}",
+                                 'user': {'id': self.wallets[wallet]}, 'pair': self.pairs[pair],
+                                 'liquidityTokenBalance': format_wei(balance)})
+
+        rows.sort(key=lambda row: row['id'])
+        first = min(arguments.get('first', default_first), max_first)
+        return [row for row in rows if row['id'] > where.get('id_gt', '')][:first]
+
+    def pair_rows(self, arguments):
+        where = arguments.get('where') or {}
+        first = min(arguments.get('first', default_first), max_first)
+        if 'id_in' in where:
+            indices = sorted(self.pair_indices[pair_id] for pair_id in where['id_in'] if pair_id in self.pair_indices)
+        else:
+            indices = range(bisect.bisect_right([pair['id'] for pair in self.pairs], where.get('id_gt', '')), pair_count)
+        return [self.pairs[index] for index in itertools.islice(indices, first)]
+
+    def token_rows(self, arguments):
+        where = arguments.get('where') or {}
+        first = min(arguments.get('first', default_first), max_first)
+        wanted = set(where.get('id_in', [token['id'] for token in self.tokens]))
+        return [token for token in self.tokens if token['id'] in wanted][:first]
+
+    # Last transaction at or before a timestamp, as used to find the block at a time
+    def transaction_rows(self, arguments):
+        timestamp = int((arguments.get('where') or {}).get('timestamp_lte', genesis_timestamp + head_block * block_time))
+        block = min(head_block, (timestamp - genesis_timestamp) // block_time)
+        if block < 1:
+            return []
+        timestamp = str(genesis_timestamp + block * block_time)
+        return [{'id': f"0x{block:064x}", 'blockNumber': str(block), 'timestamp': timestamp}]
+
+    def meta(self, block):
+        return {'block': {'number': block, 'hash': f"0x{block:064x}", 'timestamp': genesis_timestamp + block * block_time},
+                'deployment': 'QmSynthetic', 'hasIndexingErrors': False}
+
+    # Execute a parsed document and return the response body, with the rows returned per collection
+    def execute(self, operation, variables):
+        data = {}
+        rows = {}
+        for alias, field, arguments, selection in operation:
+            arguments = resolve_arguments(arguments, variables)
+            block = int((arguments.get('block') or {}).get('number', head_block))
+            if block > head_block:
+                return {'errors': [{'message': f"Failed to decode `block.number` value: subgraph has only indexed up to "
+                                               f"block number {head_block} and data for block number {block} is "
+                                               f"therefore not yet available"}]}, rows
+
+            if field in ('mints', 'burns'):
+                row = self.events(field, arguments, block)
+            elif field == 'liquidityPositions':
+                row = self.position_rows(arguments, block)
+            elif field == 'pairs':
+                row = self.pair_rows(arguments)
+            elif field == 'tokens':
+                row = self.token_rows(arguments)
+            elif field == 'transactions':
+                row = self.transaction_rows(arguments)
+            elif field == 'bundle':
+                row = {'id': '1', 'ethPrice': '2000.0'}
+            elif field == '_meta':
+                row = self.meta(block)
+            else:
+                return {'errors': [{'message': f"Type `Query` has no field `{field}`"}]}, rows
+            data[alias] = project(row, selection)
+            if isinstance(row, list):
+                rows[field] = rows.get(field, 0) + len(row)
+        return {'data': data}, rows
+
+
+# Address of a synthetic wallet
+def wallet_address(index):
+    return f"0x{wallet_prefix:04x}{index:036x}"
+
+
+# Fake graph-node serving synthetic chains at /subgraphs/name/chain<N>, with request statistics at /stats.
+# Failures can be injected per chain: faults maps a chain name to a dict with any of
+#   status       answer with this status code instead of data (e.g. 429, 503)
+#   retry_after  seconds sent in a Retry-After header with the status
+#   hang         seconds to stall before answering (or failing)
+#   drop         close the connection without answering
+#   count        requests the fault applies to before the chain recovers (every request if missing)
+class MockGraphNode(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, chain_count, address_count, events_per_address, latency=0.0, compress=False, faults=None):
+        super().__init__(('127.0.0.1', 0), MockGraphHandler)
+        # Every chain has the same wallets and history, so they share one data set
+        chain = SyntheticChain(address_count, events_per_address)
+        self.chains = {f"chain{index}": chain for index in range(chain_count)}
+        self.latency = latency
+        self.compress = compress
+        self.documents = {}
+        self.persisted = {}
+        self.faults = {chain_name: dict(fault) for chain_name, fault in (faults or {}).items()}
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'rows': {}, 'durations': [],
+                          'chain_requests': {}, 'faults': 0}
+
+    # Fault to inject into the next request to a chain, or None, using up faults limited to a count
+    def take_fault(self, chain_name):
+        with self.stats_lock:
+            fault = self.faults.get(chain_name)
+            if fault is None:
+                return None
+            if fault.get('count') is not None:
+                fault['count'] -= 1
+                if fault['count'] <= 0:
+                    del self.faults[chain_name]
+            self.stats['faults'] += 1
+            return fault
+
+    # Parse a document once; the scripts send the same few documents over and over
+    def parse(self, document):
+        if document not in self.documents:
+            self.documents[document] = DocumentParser(document).operation()
+        return self.documents[document]
+
+    def url(self, chain_name):
+        return f"http://127.0.0.1:{self.server_address[1]}/subgraphs/name/{chain_name}/"
+
+
+class MockGraphHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, headers=None):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self.server.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = gzip.compress(content, 1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        return len(content)
+
+    def do_GET(self):
+        if not self.path.startswith('/stats'):
+            self.send_body(404, {'error': 'not found'})
+            return
+
+        with self.server.stats_lock:
+            stats = dict(self.server.stats)
+        durations = sorted(stats.pop('durations'))
+        stats['p50'] = percentile(durations, 50)
+        stats['p99'] = percentile(durations, 99)
+        if 'reset' in self.path:
+            self.server.reset_stats()
+        self.send_body(200, stats)
+
+    def do_POST(self):
+        started = time.perf_counter()
+        raw = self.rfile.read(int(self.headers['Content-Length']))
+        chain_name = self.path.rstrip('/').rsplit('/', 1)[-1]
+        chain = self.server.chains.get(chain_name)
+        with self.server.stats_lock:
+            chain_requests = self.server.stats['chain_requests']
+            chain_requests[chain_name] = chain_requests.get(chain_name, 0) + 1
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        fault = self.server.take_fault(chain_name)
+        if fault is not None:
+            time.sleep(fault.get('hang', 0))
+            if fault.get('drop'):
+                self.close_connection = True
+                self.record_request(started, raw, 0, {})
+                return
+            if fault.get('status'):
+                headers = {'Retry-After': str(fault['retry_after'])} if 'retry_after' in fault else None
+                sent = self.send_body(fault['status'], {'errors': [{'message': "Injected failure"}]}, headers)
+                self.record_request(started, raw, sent, {})
+                return
+
+        rows = {}
+        try:
+            body = json.loads(raw)
+            document = body.get('query')
+            persisted = (body.get('extensions') or {}).get('persistedQuery')
+            if persisted:
+                if document is not None:
+                    self.server.persisted[persisted['sha256Hash']] = document
+                document = self.server.persisted.get(persisted['sha256Hash'])
+
+            if chain is None:
+                response = {'errors': [{'message': "Subgraph not found"}]}
+            elif document is None:
+                response = {'errors': [{'message': 'PersistedQueryNotFound'}]}
+            else:
+                response, rows = chain.execute(self.server.parse(document), body.get('variables') or {})
+        except (ValueError, KeyError, IndexError, TypeError) as error:
+            response = {'errors': [{'message': str(error)}]}
+
+        sent = self.send_body(200 if chain is not None else 404, response)
+        self.record_request(started, raw, sent, rows)
+
+    # Add a request, its bytes, its duration and the rows it returned per collection to the statistics
+    def record_request(self, started, raw, sent, rows):
+        with self.server.stats_lock:
+            stats = self.server.stats
+            stats['requests'] += 1
+            stats['bytes_in'] += len(raw)
+            stats['bytes_out'] += sent
+            stats['durations'].append(time.perf_counter() - started)
+            for entity, count in rows.items():
+                stats['rows'][entity] = stats['rows'].get(entity, 0) + count
+
+
+# Nearest-rank percentile of sorted values, or None without values
+def percentile(values, rank):
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, -(-len(values) * rank // 100) - 1))]
+
+
+# Run the mock graph-node in its own process until terminated, reporting its port through a pipe
+def serve_mock(connection, chain_count, address_count, events_per_address, pairs, latency, compress, faults=None):
+    global pair_count
+    pair_count = pairs
+    server = MockGraphNode(chain_count, address_count, events_per_address, latency, compress, faults)
+    connection.send(server.server_address[1])
+    server.serve_forever()
+
+
+# Stand-in for inquirer, answering every prompt with all stored entries (or the first, for single choices)
+def fake_inquirer():
+    module = types.ModuleType('inquirer')
+
+    class Question:
+        def __init__(self, name, message=None, choices=(), **kwargs):
+            self.name = name
+            self.choices = [choice for choice in choices if not choice.startswith('New ')]
+
+    class Checkbox(Question):
+        def answer(self):
+            return self.choices
+
+    class List(Question):
+        def answer(self):
+            return self.choices[0]
+
+    module.Checkbox = Checkbox
+    module.List = List
+    module.prompt = lambda questions: {question.name: question.answer() for question in questions}
+    return module
+
+
+# Run one script end to end in this (fresh) process, in a scratch directory whose subgraph_data.json
+# lists the mock chains, their position strategy and the wallets. Returns the wall time, peak RSS and
+# output of the run.
+def run_script(script, script_arguments, workdir, chain_urls, address_count, strategy):
+    with open(os.path.join(workdir, 'subgraph_data.json'), 'w') as f:
+        json.dump({'subgraphs': chain_urls, 'strategies': {chain_name: strategy for chain_name in chain_urls},
+                   'addresses': {f"wallet{index}": wallet_address(index) for index in range(address_count)}}, f)
+
+    os.chdir(workdir)
+    sys.modules['inquirer'] = fake_inquirer()
+    builtins.input = lambda prompt='': 'done'
+    sys.argv = [script] + script_arguments
+
+    output = io.StringIO()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            runpy.run_path(script, run_name='__main__')
+        except SystemExit:
+            pass
+    wall = time.perf_counter() - started
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024  # Linux reports kilobytes
+    return wall, peak_rss, output.getvalue()
+
+
+# Fetch (and reset) the mock graph-node's request statistics
+def fetch_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats?reset") as response:
+        return json.loads(response.read())
+
+
+# Benchmark every script on one scenario, repeating each run and returning one report per script
+def run_scenario(context, scripts, script_arguments, chain_count, address_count, event_count, latency, compress,
+                 repeat, strategy, faults=None):
+    events_per_address = max(1, event_count // address_count)
+    receiver, sender = context.Pipe(duplex=False)
+    server = context.Process(target=serve_mock, daemon=True,
+                             args=(sender, chain_count, address_count, events_per_address, pair_count, latency,
+                                   compress, faults))
+    server.start()
+    port = receiver.recv()
+    chain_urls = {f"chain{index}": f"http://127.0.0.1:{port}/subgraphs/name/chain{index}/"
+                  for index in range(chain_count)}
+
+    reports = []
+    try:
+        for script in scripts:
+            walls, peaks, runs = [], [], []
+            with context.Pool(1, maxtasksperchild=1) as pool:
+                for _ in range(repeat):
+                    with tempfile.TemporaryDirectory() as workdir:
+                        wall, peak_rss, output = pool.apply(run_script, (script, script_arguments, workdir, chain_urls,
+                                                                         address_count, strategy))
+                    walls.append(wall)
+                    peaks.append(peak_rss)
+                    runs.append((fetch_stats(port), output))
+
+            walls.sort()
+            stats = [run_stats for run_stats, _ in runs]
+            event_rows = sum(run_stats['rows'].get('mints', 0) + run_stats['rows'].get('burns', 0) for run_stats in stats)
+            failures = sum(len(re.findall(r'^.*(?:Failed|errors).*$', output, re.MULTILINE)) for _, output in runs)
+            reports.append({
+                'script': os.path.basename(script), 'chains': chain_count, 'addresses': address_count,
+                'events': events_per_address * address_count,
+                'wall_p50': percentile(walls, 50), 'wall_p99': percentile(walls, 99),
+                'events_per_second': event_rows / sum(walls),
+                'request_p50': percentile(sorted(run_stats['p50'] for run_stats in stats if run_stats['p50']), 50),
+                'request_p99': max((run_stats['p99'] for run_stats in stats if run_stats['p99']), default=None),
+                'requests': sum(run_stats['requests'] for run_stats in stats) // repeat,
+                'bytes': sum(run_stats['bytes_in'] + run_stats['bytes_out'] for run_stats in stats) // repeat,
+                'peak_rss': max(peaks), 'failures': failures,
+            })
+    finally:
+        server.terminate()
+        server.join()
+    return reports
+
+
+# Print reports as an aligned table
+def print_reports(reports):
+    columns = [('script', '{}'), ('chains', '{}'), ('addresses', '{}'), ('events', '{}'),
+               ('wall_p50', '{:.3f}s'), ('wall_p99', '{:.3f}s'), ('events_per_second', '{:,.0f}'),
+               ('request_p50', '{:.1f}ms'), ('request_p99', '{:.1f}ms'), ('requests', '{}'),
+               ('bytes', '{:,}'), ('peak_rss', '{:.1f}MB'), ('failures', '{}')]
+
+    def cell(report, name, template):
+        value = report[name]
+        if value is None:
+            return '-'
+        if name.startswith('request_p'):
+            value *= 1000
+        if name == 'peak_rss':
+            value /= 1024 * 1024
+        return template.format(value)
+
+    rows = [[name.replace('_', ' ') for name, _ in columns]]
+    rows += [[cell(report, name, template) for name, template in columns] for report in reports]
+    widths = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+# Load a script as a fresh module, so every check starts without breakers, endpoint statistics or sessions
+def load_script(script):
+    spec = importlib.util.spec_from_file_location(f"checked_{os.path.basename(script).replace('.', '_')}", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    # Short delays keep the checks quick; each check sets what it relies on
+    module.retry_base_delay = 0.01
+    module.breaker_cooldown = 1
+    module.hedge_delay = 0.3
+    module.request_timeout = (2, 10)
+    return module
+
+
+# Send a head query through a function of the script, returning its answer and the seconds it took
+def timed_head_query(send, *arguments):
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        result = send(*arguments, {'query': "query Head { _meta { block { number } } }"}, "head block")
+    return result, time.perf_counter() - started
+
+
+# Checks of the retry, circuit breaker, hedging and routing layer and of the cache's reorg rollback of a
+# script, against a mock whose chain0 is given faults and whose chain1 serves the same data as its mirror.
+# Returns whether all passed.
+def check_resilience(script):
+    server = MockGraphNode(2, 2, 10)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    primary, mirror = server.url('chain0'), server.url('chain1')
+
+    def answered(result):
+        return result is not None and 'data' in result
+
+    def requests_to(chain_name):
+        return server.stats['chain_requests'].get(chain_name, 0)
+
+    def retries_transient_statuses(module):
+        server.faults['chain0'] = {'status': 503, 'count': 2}
+        result, _ = timed_head_query(module.send_with_retries, primary)
+        return answered(result) and requests_to('chain0') == 3 and module.counters.get(('retries', ())) == 2
+
+    def honours_retry_after(module):
+        server.faults['chain0'] = {'status': 429, 'retry_after': 1, 'count': 1}
+        result, seconds = timed_head_query(module.send_with_retries, primary)
+        return answered(result) and requests_to('chain0') == 2 and seconds >= 1
+
+    def gives_up_on_client_errors(module):
+        server.faults['chain0'] = {'status': 400}
+        result, _ = timed_head_query(module.send_with_retries, primary)
+        return result is None and requests_to('chain0') == 1
+
+    def opens_and_recloses_breaker(module):
+        module.max_retries = 0
+        module.breaker_threshold = 3
+        server.faults['chain0'] = {'status': 503}
+        for _ in range(5):
+            timed_head_query(module.send_with_retries, primary)
+        opened = requests_to('chain0') == 3 and module.breaker_open(primary)
+
+        # After the cooldown a single probe goes through and closes the breaker
+        del server.faults['chain0']
+        time.sleep(module.breaker_cooldown)
+        result, _ = timed_head_query(module.send_with_retries, primary)
+        return opened and answered(result) and requests_to('chain0') == 4 and not module.breaker_open(primary)
+
+    def hedges_stalled_endpoint(module):
+        module.chain_endpoints[primary] = [primary, mirror]
+        server.faults['chain0'] = {'hang': 3, 'count': 1}
+        result, seconds = timed_head_query(module.send_hedged, primary)
+        return (answered(result) and seconds < 1.5 and requests_to('chain1') == 1
+                and module.counters.get(('hedged_requests', ())) == 1)
+
+    def fails_over_to_mirror(module):
+        module.chain_endpoints[primary] = [primary, mirror]
+        module.max_retries = 1
+        server.faults['chain0'] = {'status': 500}
+        result, _ = timed_head_query(module.send_hedged, primary)
+        return answered(result) and requests_to('chain0') == 2 and requests_to('chain1') == 1
+
+    def routes_around_failing_endpoint(module):
+        module.chain_endpoints[primary] = [primary, mirror]
+        module.max_retries = 0
+        module.breaker_threshold = 100
+        timed_head_query(module.send_with_retries, mirror)
+        server.faults['chain0'] = {'drop': True}
+        for _ in range(4):
+            timed_head_query(module.send_with_retries, primary)
+        return module.route_endpoints(primary) == [mirror, primary]
+
+    def rolls_back_reorged_blocks(module):
+        wallet = wallet_address(0)
+        with tempfile.TemporaryDirectory() as workdir:
+            module.cache_file = os.path.join(workdir, 'cache.db')
+            # Deep enough to drop some of the wallet's events, which are spread over the whole history
+            module.reorg_depth = head_block // 3
+
+            def net_liquidity():
+                notices = io.StringIO()
+                with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(notices):
+                    summary = module.fetch_address_summary(primary, wallet)
+                return {pair_id: position.net_liquidity for pair_id, position in summary.items()}, notices.getvalue()
+
+            before, _ = net_liquidity()
+
+            # Make the block the ledger was last updated at look orphaned
+            with contextlib.closing(module.open_cache()) as connection, connection:
+                connection.execute("UPDATE watermarks SET block_hash = '0xorphaned' WHERE address = ?",
+                                   (wallet.lower(),))
+            server.reset_stats()
+            after, notices = net_liquidity()
+            refetched = server.stats['rows'].get('mints', 0) + server.stats['rows'].get('burns', 0)
+            watermark = module.load_watermark(primary, wallet)
+            return (after == before and 'reorged' in notices and refetched > 0
+                    and watermark == (head_block, f"0x{head_block:064x}"))
+
+    checks = [retries_transient_statuses, honours_retry_after, gives_up_on_client_errors,
+              opens_and_recloses_breaker, hedges_stalled_endpoint, fails_over_to_mirror,
+              routes_around_failing_endpoint, rolls_back_reorged_blocks]
+    passed = 0
+    try:
+        for check in checks:
+            server.faults.clear()
+            server.reset_stats()
+            try:
+                succeeded = check(load_script(script))
+            except Exception as error:
+                print(f"{check.__name__}: {error!r}")
+                succeeded = False
+            passed += succeeded
+            print(f"{'PASS' if succeeded else 'FAIL'}  {check.__name__.replace('_', ' ')}")
+    finally:
+        server.shutdown()
+
+    print(f"{passed} of {len(checks)} checks passed")
+    return passed == len(checks)
+
+
+# Read command line options
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark GraphQuery scripts against a local fake graph-node.")
+    parser.add_argument('--scripts', nargs='+', default=['GraphQuery0.4.py'], metavar='SCRIPT',
+                        help="scripts to compare (default: GraphQuery0.4.py)")
+    parser.add_argument('--script-args', default='', metavar='ARGS',
+                        help="command line passed to each script, e.g. '--batch --engine numpy'")
+    parser.add_argument('--chains', nargs='+', type=int, default=[1, 10], metavar='N',
+                        help="chain counts to run (default: 1 10)")
+    parser.add_argument('--addresses', nargs='+', type=int, default=[1, 100], metavar='N',
+                        help="wallet counts to run (default: 1 100)")
+    parser.add_argument('--events', nargs='+', type=int, default=[100, 10000], metavar='N',
+                        help="events per chain, split between the wallets (default: 100 10000)")
+    parser.add_argument('--pairs', type=int, default=pair_count, metavar='N',
+                        help=f"pairs per chain (default: {pair_count})")
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+                        help="delay the fake graph-node adds to every request (default: 0)")
+    parser.add_argument('--gzip', action='store_true',
+                        help="compress responses for clients that accept gzip")
+    parser.add_argument('--strategy', choices=['events', 'positions'], default='events',
+                        help="how the scripts read positions, for those that support strategies (default: events)")
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help="runs per script and scenario (default: 3)")
+    parser.add_argument('--faults', type=json.loads, metavar='JSON',
+                        help="failures the fake graph-node injects per chain, e.g. "
+                             "'{\"chain0\": {\"status\": 429, \"retry_after\": 1, \"count\": 5}}'; a fault "
+                             "may set status, retry_after, hang (seconds), drop (close the connection) and count")
+    parser.add_argument('--check', action='store_true',
+                        help="instead of benchmarking, check the first script's retries, circuit breakers, hedging, "
+                             "routing and reorg rollback against injected failures")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the reports to this file, for comparing runs")
+    return parser.parse_args()
+
+
+# Run the benchmark
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    pair_count = arguments.pairs
+
+    if arguments.check:
+        sys.exit(0 if check_resilience(os.path.abspath(arguments.scripts[0])) else 1)
+
+    # Fresh processes for the server and every run, so runs neither share caches nor peak RSS
+    context = multiprocessing.get_context('spawn')
+    scripts = [os.path.abspath(script) for script in arguments.scripts]
+
+    reports = []
+    for chain_count, address_count, event_count in itertools.product(arguments.chains, arguments.addresses,
+                                                                      arguments.events):
+        reports += run_scenario(context, scripts, shlex.split(arguments.script_args), chain_count, address_count,
+                                event_count, arguments.latency, arguments.gzip, arguments.repeat, arguments.strategy,
+                                arguments.faults)
+    print_reports(reports)
+
+    if arguments.json:
+        with open(arguments.json, 'w') as f:
+            json.dump(reports, f, indent=2)
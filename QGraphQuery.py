@@ -4,27 +4,14 @@ import json
 # Define the GraphQL endpoint (replace with your subgraph's GraphQL URL)
 graphql_url = "http://162.244.80.145:8000/subgraphs/name/elkfinance-q/"
 
-# Define the GraphQL query
-query = """
-{
-  mints(where: { to: "0xB2312009bEd27B5962169586129fF55b185129e2" }) {
-    id
-    liquidity
-    pair {
-      id
-      token0 {
-        symbol
-      }
-      token1 {
-        symbol
-      }
-    }
-    transaction {
-      blockNumber
-      timestamp
-    }
-  }
-  burns(where: { sender: "0xB2312009bEd27B5962169586129fF55b185129e2" }) {
+# Address whose liquidity positions are reported
+address = "0xB2312009bEd27B5962169586129fF55b185129e2"
+
+# Rows requested per page (graph-node caps a collection at 100 rows unless `first` is given)
+page_size = 1000
+
+# Fields requested for each collection
+mint_burn_fields = """
     id
     liquidity
     pair {
@@ -40,8 +27,9 @@ query = """
       blockNumber
       timestamp
     }
-  }
-  pairs {
+"""
+
+pair_fields = """
     id
     token0 {
       symbol
@@ -52,17 +40,51 @@ query = """
     reserve0
     reserve1
     totalSupply
-  }
-}
 """
 
-# Send the request to the subgraph
-response = requests.post(graphql_url, json={'query': query})
+collections = [
+    ('mints', f'to: "{address}"', mint_burn_fields),
+    ('burns', f'sender: "{address}"', mint_burn_fields),
+    ('pairs', '', pair_fields),
+]
+
+# Walk each collection in id order until a short page is returned
+response_json = {'data': {}}
+for entity, where, fields in collections:
+    rows = []
+    last_id = ""
+    while True:
+        query = f"""
+        {{
+          {entity}(first: {page_size}, orderBy: id, orderDirection: asc,
+                   where: {{ {where}{', ' if where else ''}id_gt: "{last_id}" }}) {{
+            {fields}
+          }}
+        }}
+        """
+
+        # Send the request to the subgraph
+        response = requests.post(graphql_url, json={'query': query})
+        if response.status_code != 200:
+            break
+
+        page_json = response.json()
+        if 'errors' in page_json or 'data' not in page_json:
+            response_json = page_json
+            break
+
+        page = page_json['data'][entity]
+        rows.extend(page)
+        if len(page) < page_size:
+            break
+        last_id = page[-1]['id']
+
+    if response.status_code != 200 or 'errors' in response_json or 'data' not in response_json:
+        break
+    response_json['data'][entity] = rows
 
 # Check if the request was successful
 if response.status_code == 200:
-    response_json = response.json()
-
     if 'errors' in response_json:
         print("GraphQL query errors:", json.dumps(response_json['errors'], indent=2))
     elif 'data' in response_json: